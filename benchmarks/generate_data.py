@@ -0,0 +1,77 @@
+# Synthetic data for the benchmarks: a patients_data.csv in the app's own
+# layout and a hospital upload file in the format the File Upload demo takes.
+#
+#   python benchmarks/generate_data.py --sizes 10000 100000 1000000 --out /tmp/ppapp-data
+#
+# Names repeat the way real ones do (first + last from short lists), contacts
+# are unique, and the first `linked` patients carry FHIR IDs (bench-0, bench-1,
+# ...) that the mock FHIR server in mock_fhir_server.py knows about.
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+PATIENT_COLUMNS = [
+    "Name", "Age", "Gender", "Contact",
+    "Blood Type", "Allergies", "Medical History",
+    "FHIR_Patient_ID", "Last_Sync", "Source"
+]
+FIRST_NAMES = ["Ann", "Bob", "Carla", "Dev", "Eve", "Femi", "Grace", "Hiro", "Ines", "Jon",
+               "Kara", "Liam", "Maya", "Nils", "Omar", "Priya", "Quinn", "Rosa", "Sam", "Tara"]
+LAST_NAMES = ["Smith", "Lee", "Diaz", "Patel", "Stone", "Ade", "Kim", "Novak", "Silva", "Brown",
+              "Khan", "Garcia", "Rossi", "Muller", "Tanaka", "Okafor", "Jensen", "Cohen", "Ray", "Walsh"]
+BLOOD_TYPES = ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-", "Unknown"]
+ALLERGIES = ["None", "Penicillin", "Peanuts", "Latex", "Shellfish", "Pollen"]
+HISTORIES = ["Healthy", "Diabetes", "Hypertension", "Asthma", "Annual checkup", "Recent surgery"]
+
+def _names(rng, n):
+    return pd.Series(rng.choice(FIRST_NAMES, n)) + " " + pd.Series(rng.choice(LAST_NAMES, n))
+
+def synthetic_patients(n, linked=0, seed=0):
+    rng = np.random.default_rng(seed)
+    linked = min(linked, n)
+    is_linked = np.arange(n) < linked
+    fhir_ids = np.where(is_linked, np.char.add("bench-", np.arange(n).astype(str)), "")
+    return pd.DataFrame({
+        "Name": _names(rng, n),
+        "Age": rng.integers(0, 100, n),
+        "Gender": rng.choice(["Male", "Female", "Other"], n),
+        "Contact": np.char.mod("555-%07d", np.arange(n)),
+        "Blood Type": rng.choice(BLOOD_TYPES, n),
+        "Allergies": rng.choice(ALLERGIES, n),
+        "Medical History": rng.choice(HISTORIES, n),
+        "FHIR_Patient_ID": fhir_ids,
+        "Last_Sync": np.where(is_linked, "2024-01-01 00:00:00", ""),
+        "Source": np.where(is_linked, "FHIR Server", rng.choice(["Manual Entry", "Hospital Integration"], n))
+    })[PATIENT_COLUMNS]
+
+def hospital_upload(n, seed=1):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "Name": _names(rng, n),
+        "Age": rng.integers(0, 100, n),
+        "Gender": rng.choice(["Male", "Female", "Other"], n),
+        "Contact": np.char.mod("556-%07d", np.arange(n)),
+        "BloodType": rng.choice(BLOOD_TYPES, n),
+        "Allergies": rng.choice(ALLERGIES, n),
+        "MedicalHistory": rng.choice(HISTORIES, n)
+    })
+
+def write_datasets(size, out_dir, linked=2000):
+    os.makedirs(out_dir, exist_ok=True)
+    patients_path = os.path.join(out_dir, f"patients_{size}.csv")
+    hospital_path = os.path.join(out_dir, f"hospital_{size}.csv")
+    synthetic_patients(size, linked=linked).to_csv(patients_path, index=False)
+    hospital_upload(size).to_csv(hospital_path, index=False)
+    return patients_path, hospital_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic patient and hospital upload files")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--linked", type=int, default=2000, help="patients with FHIR IDs in each file")
+    parser.add_argument("--out", default="benchmark_data")
+    args = parser.parse_args()
+    for size in args.sizes:
+        for path in write_datasets(size, args.out, args.linked):
+            print(f"✅ {path} ({os.path.getsize(path) / 1024 / 1024:,.1f} MB)")
@@ -0,0 +1,109 @@
+# Load test for the hospital ingestion endpoint (POST /api/patients).
+#
+# Start the app and open "Hospital Integration Demo" -> "API Integration" once so
+# the endpoint is listening, then run for example:
+#
+#   python benchmarks/loadtest_ingest.py --requests 20000 --concurrency 64
+#
+# Each connection is kept alive and sends requests back to back. The summary
+# compares the number of accepted patients with the number of store writes
+# (batches) the server made while the test ran.
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+NAMES = ["Ann Lee", "Bob Ray", "Carla Diaz", "Dev Patel", "Eve Stone", "Femi Ade"]
+
+def make_patient(i):
+    return {
+        "patient_id": f"LOAD-{i}",
+        "name": f"{random.choice(NAMES)} {i}",
+        "age": random.randint(0, 99),
+        "gender": random.choice(["Male", "Female", "Other"]),
+        "contact": f"555-{i % 10000:04d}",
+        "blood_type": random.choice(["A+", "O+", "B-", "AB+"]),
+        "hospital": "Load Test Hospital"
+    }
+
+def health(base_url):
+    with urlopen(f"{base_url}/api/health", timeout=10) as response:
+        return json.load(response)
+
+async def worker(host, port, jobs, batch, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            try:
+                start = jobs.pop()
+            except IndexError:
+                break
+            payload = make_patient(start) if batch == 1 else [make_patient(start + j) for j in range(batch)]
+            body = json.dumps(payload).encode("utf-8")
+            request = (f"POST /api/patients HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                       f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body
+            sent = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - sent)
+            status = int(status_line.split()[1])
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+async def run(args):
+    url = urlparse(args.url)
+    base_url = f"{url.scheme}://{url.netloc}"
+    before = health(base_url)
+    jobs = list(range(0, args.requests * args.batch, args.batch))
+    latencies, statuses = [], {}
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        worker(url.hostname, url.port or 80, jobs, args.batch, latencies, statuses)
+        for _ in range(args.concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+
+    # Give the server time to flush what is still queued
+    deadline = time.time() + 30
+    after = health(base_url)
+    while after["queued"] and time.time() < deadline:
+        time.sleep(0.25)
+        after = health(base_url)
+
+    latencies.sort()
+    pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 2) if latencies else None
+    return {
+        "requests": len(latencies),
+        "patients_per_request": args.batch,
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "patients_per_second": round(len(latencies) * args.batch / elapsed, 1),
+        "latency_ms": {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": pick(1.0)},
+        "statuses": statuses,
+        "patients_written": after["written"] - before["written"],
+        "store_writes": after["batches"] - before["batches"],
+        "still_queued": after["queued"]
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the patient ingestion endpoint")
+    parser.add_argument("--url", default="http://127.0.0.1:8502/api/patients")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--batch", type=int, default=1, help="patients per request")
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
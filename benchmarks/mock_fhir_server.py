@@ -0,0 +1,256 @@
+# Local FHIR R4 stand-in for the benchmarks. It serves paginated Patient and
+# Observation searchset Bundles, _id and _lastUpdated searches, Patient reads,
+# batch Bundles and a Bulk Data Patient/$export (kick-off, status polling and
+# NDJSON output files), with a configurable delay on every request.
+#
+#   python benchmarks/mock_fhir_server.py --port 8080 --patients 10000 --latency 0.05
+#
+# Patients are bench-0 ... bench-N. Every tenth one reports a lastUpdated in
+# the future, so an incremental sync always finds about 10% of them changed.
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, unquote, urlparse
+
+from generate_data import FIRST_NAMES, LAST_NAMES
+
+class MockFHIRServer:
+    def __init__(self, patients=10000, latency=0.0, observations_per_patient=6, port=0,
+                 export_polls=2, export_file_patients=10000):
+        self.patients = patients
+        self.latency = latency
+        self.observations_per_patient = observations_per_patient
+        self.export_polls = export_polls  # status polls answered 202 before an export completes
+        self.export_file_patients = export_file_patients  # patients per NDJSON output file
+        self.exports = {}
+        self.requests = 0
+        self._names = [self._name(i) for i in range(patients)]
+        self._lock = threading.Lock()
+        handler = type("Handler", (_Handler,), {"mock": self})
+        self.httpd = _Server(("127.0.0.1", port), handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True, name="mock-fhir").start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _name(self, i):
+        return FIRST_NAMES[i % len(FIRST_NAMES)], LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)]
+
+    def patient(self, i):
+        given, family = self._names[i]
+        return {
+            "resourceType": "Patient",
+            "id": f"bench-{i}",
+            "meta": {"versionId": "1", "lastUpdated": "2030-01-01T00:00:00Z" if i % 10 == 0 else "2024-01-01T00:00:00Z"},
+            "name": [{"given": [given], "family": family}],
+            "gender": ("male", "female", "other")[i % 3],
+            "birthDate": f"{1940 + i % 80}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            "telecom": [{"system": "phone", "value": f"555-{i:07d}"}]
+        }
+
+    def observations(self, i):
+        resources = []
+        for k in range(self.observations_per_patient):
+            effective = f"2024-{1 + k % 12:02d}-{1 + k % 28:02d}T08:00:00Z"
+            base = {"resourceType": "Observation", "id": f"bench-{i}-{k}", "status": "final",
+                    "subject": {"reference": f"Patient/bench-{i}"}, "effectiveDateTime": effective}
+            if k % 2:
+                base["code"] = {"coding": [{"system": "http://loinc.org", "code": "85354-9"}]}
+                base["component"] = [
+                    {"code": {"coding": [{"system": "http://loinc.org", "code": "8480-6"}]},
+                     "valueQuantity": {"value": 110 + (i + k) % 40, "unit": "mmHg"}},
+                    {"code": {"coding": [{"system": "http://loinc.org", "code": "8462-4"}]},
+                     "valueQuantity": {"value": 70 + (i + k) % 20, "unit": "mmHg"}}
+                ]
+            else:
+                base["code"] = {"coding": [{"system": "http://loinc.org", "code": "8867-4"}]}
+                base["valueQuantity"] = {"value": 60 + (i + k) % 40, "unit": "beats/minute"}
+            resources.append(base)
+        return resources
+
+    def export_patients(self, since):
+        # Patient indexes in an export; with _since only those updated after it
+        if not since:
+            return list(range(self.patients))
+        return [i for i in range(self.patients) if self.patient(i)["meta"]["lastUpdated"] > since]
+
+    def export_resources(self, job, resource_type, part):
+        indexes = self.exports[job]["patients"][part * self.export_file_patients:(part + 1) * self.export_file_patients]
+        if resource_type == "Patient":
+            return [self.patient(i) for i in indexes]
+        return [obs for i in indexes for obs in self.observations(i)]
+
+    def index(self, fhir_id):
+        prefix, _, number = fhir_id.partition("-")
+        if prefix == "bench" and number.isdigit() and int(number) < self.patients:
+            return int(number)
+        return None
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-download when an import is interrupted on purpose
+        pass
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload=None, headers=None, content_type="application/fhir+json"):
+        if isinstance(payload, bytes):
+            body = payload
+        else:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self):
+        with self.mock._lock:
+            self.mock.requests += 1
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+
+    def _searchset(self, path, query, resources):
+        count = int(query.get("_count", ["20"])[0])
+        offset = int(query.get("_offset", ["0"])[0])
+        page = resources[offset:offset + count]
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(resources),
+            "entry": [{"resource": r, "search": {"mode": "match"}} for r in page],
+            "link": []
+        }
+        if offset + count < len(resources):
+            params = {key: values[0] for key, values in query.items() if key not in ("_count", "_offset")}
+            params.update(_count=count, _offset=offset + count)
+            next_query = "&".join(f"{key}={value}" for key, value in params.items())
+            bundle["link"].append({"relation": "next", "url": f"{self.mock.url}/{path}?{next_query}"})
+        return bundle
+
+    def _export_kickoff(self, query):
+        if self.headers.get("Prefer") != "respond-async":
+            return self._send(400, {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "diagnostics": "Prefer: respond-async is required"}]})
+        types = query.get("_type", ["Patient,Observation"])[0].split(",")
+        since = query.get("_since", [""])[0]
+        with self.mock._lock:
+            job = str(len(self.mock.exports) + 1)
+            self.mock.exports[job] = {"types": types, "patients": self.mock.export_patients(since),
+                                      "polls": self.mock.export_polls, "request": self.path}
+        self._send(202, headers={"Content-Location": f"{self.mock.url}/$export-poll/{job}"})
+
+    def _export_status(self, job):
+        export = self.mock.exports.get(job)
+        if export is None:
+            return self._send(404)
+        if export["polls"] > 0:
+            export["polls"] -= 1
+            done = self.mock.export_polls - export["polls"]
+            return self._send(202, headers={"X-Progress": f"{100 * done // (self.mock.export_polls + 1)}% complete", "Retry-After": "0"})
+        size = self.mock.export_file_patients
+        files = (len(export["patients"]) + size - 1) // size
+        per_patient = {"Patient": 1, "Observation": self.mock.observations_per_patient}
+        output = [
+            {"type": resource_type, "url": f"{self.mock.url}/$export-file/{job}/{resource_type}/{part}",
+             "count": len(export["patients"][part * size:(part + 1) * size]) * per_patient.get(resource_type, 0)}
+            for resource_type in export["types"] if resource_type in per_patient
+            for part in range(files)
+        ]
+        self._send(200, {
+            "transactionTime": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "request": f"{self.mock.url}{export['request']}",
+            "requiresAccessToken": False,
+            "output": output,
+            "error": []
+        }, content_type="application/json")
+
+    def do_GET(self):
+        self._begin()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = unquote(url.path).strip("/").split("/")
+
+        if parts[-1] == "$export":
+            return self._export_kickoff(query)
+        if parts[0] == "$export-poll" and len(parts) == 2:
+            return self._export_status(parts[1])
+        if parts[0] == "$export-file" and len(parts) == 4 and parts[1] in self.mock.exports:
+            lines = [json.dumps(resource) for resource in self.mock.export_resources(parts[1], parts[2], int(parts[3]))]
+            return self._send(200, ("\n".join(lines) + "\n").encode("utf-8"), content_type="application/fhir+ndjson")
+
+        if parts[0] == "Patient" and len(parts) == 2:
+            i = self.mock.index(parts[1])
+            return self._send(404) if i is None else self._send(200, self.mock.patient(i))
+
+        if parts[0] == "Patient":
+            if "_id" in query:
+                indexes = [self.mock.index(fhir_id) for fhir_id in query["_id"][0].split(",")]
+                resources = [self.mock.patient(i) for i in indexes if i is not None]
+            else:
+                term = query.get("name", [""])[0].lower()
+                matches = [i for i, (given, family) in enumerate(self.mock._names)
+                           if term in given.lower() or term in family.lower()]
+                offset = int(query.get("_offset", ["0"])[0])
+                count = int(query.get("_count", ["20"])[0])
+                # Only the requested page is built; the rest are placeholders for paging
+                resources = [None] * len(matches)
+                for position in range(offset, min(offset + count, len(matches))):
+                    resources[position] = self.mock.patient(matches[position])
+            since = query.get("_lastUpdated", [""])[0]
+            if since.startswith("gt"):
+                resources = [r for r in resources if r and r["meta"]["lastUpdated"] > since[2:]]
+            return self._send(200, self._searchset("Patient", query, resources))
+
+        if parts[0] == "Observation":
+            indexes = [self.mock.index(fhir_id) for fhir_id in query.get("patient", [""])[0].split(",")]
+            resources = [obs for i in indexes if i is not None for obs in self.mock.observations(i)]
+            return self._send(200, self._searchset("Observation", query, resources))
+
+        self._send(404)
+
+    def do_DELETE(self):
+        self._begin()
+        parts = unquote(urlparse(self.path).path).strip("/").split("/")
+        if parts[0] == "$export-poll" and self.mock.exports.pop(parts[-1], None) is not None:
+            return self._send(202)
+        self._send(404)
+
+    def do_POST(self):
+        self._begin()
+        length = int(self.headers.get("Content-Length") or 0)
+        bundle = json.loads(self.rfile.read(length) or b"{}")
+        entries = []
+        for entry in bundle.get("entry", []):
+            i = self.mock.index(entry.get("request", {}).get("url", "").rpartition("/")[2])
+            if i is None:
+                entries.append({"response": {"status": "404 Not Found"}})
+            else:
+                entries.append({"resource": self.mock.patient(i), "response": {"status": "200 OK"}})
+        self._send(200, {"resourceType": "Bundle", "type": "batch-response", "entry": entries})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a mock FHIR R4 server for benchmarks")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    args = parser.parse_args()
+    server = MockFHIRServer(args.patients, args.latency, port=args.port)
+    print(f"✅ Mock FHIR server on {server.url}/ ({args.patients} patients, {args.latency}s latency)")
+    server.httpd.serve_forever()
@@ -0,0 +1,205 @@
+# Benchmark suite for ppapp.py. For every dataset size it generates a fresh
+# patients_data.csv and hospital upload in a scratch directory, starts the
+# mock FHIR server, and times the app's storage, search, import and FHIR
+# paths (including a Bulk Data $export) through the same functions the
+# Streamlit pages call.
+#
+#   python benchmarks/run_benchmarks.py --sizes 10000 100000 --backend csv --output results.json
+#   python benchmarks/run_benchmarks.py --sizes 10000 --compare results.json
+#
+# Results are JSON (commit, environment and seconds per operation) so runs on
+# different commits can be compared with --compare, which exits non-zero when
+# an operation got slower than --threshold times the baseline.
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import pandas as pd
+
+from generate_data import hospital_upload, synthetic_patients
+from mock_fhir_server import MockFHIRServer
+
+def timed(fn, repeat=1):
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return {"seconds": round(min(times), 6), "median": round(statistics.median(times), 6), "repeat": repeat}, result
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--", "ppapp.py"], cwd=ROOT, capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except OSError:
+        return "", False
+
+def reset_app_state(ppapp, backend):
+    ppapp.STORAGE_CONFIG["backend"] = backend
+    for resource in (ppapp.get_store, ppapp.get_deduplicator, ppapp.get_observation_store):
+        resource.clear()
+
+def bench_size(ppapp, size, args, server):
+    workdir = tempfile.mkdtemp(prefix=f"ppapp-bench-{size}-")
+    os.chdir(workdir)
+    results = {}
+    try:
+        synthetic_patients(size, linked=args.linked).to_csv("patients_data.csv", index=False)
+        hospital_upload(size).to_csv("hospital_upload.csv", index=False)
+        reset_app_state(ppapp, args.backend)
+
+        results["open_store"], _ = timed(ppapp.get_store)
+        results["load_data_cold"], df = timed(ppapp.load_data)
+        results["load_data_warm"], _ = timed(ppapp.load_data, repeat=3)
+        results["load_data_projection"], _ = timed(lambda: ppapp.load_data(columns=["Name", "Source"]), repeat=3)
+        results["save_data"], _ = timed(lambda: ppapp.save_data(df))
+
+        # add_patient appends one row per form submit
+        def add_patients():
+            for i in range(args.inserts):
+                ppapp.append_patients(pd.DataFrame([{
+                    "Name": f"Bench Insert {i}", "Age": 40, "Gender": "Female", "Contact": f"557-{i:07d}",
+                    "Blood Type": "O+", "Allergies": "None", "Medical History": "Healthy",
+                    "FHIR_Patient_ID": "", "Last_Sync": "", "Source": "Manual Entry"
+                }]))
+        results["add_patient"], _ = timed(add_patients)
+        results["add_patient"]["per_insert"] = round(results["add_patient"]["seconds"] / args.inserts, 6)
+
+        results["name_search_first"], _ = timed(lambda: ppapp.search_patient_names("ann"))
+        results["name_search"], matches = timed(lambda: ppapp.search_patient_names("ann"), repeat=5)
+        results["name_search"]["matches"] = len(matches)
+        results["name_search_fuzzy"], _ = timed(lambda: ppapp.search_patient_names("Gracee Kimm", fuzzy=True), repeat=3)
+
+        def view_patients_metrics():
+            aggregates = ppapp.patient_aggregates()
+            total = ppapp.count_patients()
+            page, _ = ppapp.find_patients_page(limit=50, total=total)
+            return aggregates, total, page
+        results["view_patients_metrics"], _ = timed(view_patients_metrics, repeat=5)
+        results["view_patients_filtered_sorted"], _ = timed(
+            lambda: ppapp.find_patients_page([("Gender", "==", "Female")], sort_by="Age", ascending=False, offset=100, limit=50),
+            repeat=3
+        )
+
+        results["hospital_import"], report = timed(lambda: ppapp.import_hospital_file("hospital_upload.csv"))
+        results["hospital_import"]["report"] = report
+        results["hospital_reimport"], report = timed(lambda: ppapp.import_hospital_file("hospital_upload.csv"))
+        results["hospital_reimport"]["report"] = report
+
+        client = ppapp.FHIRClient({**ppapp.FHIR_CONFIG, "base_url": f"{server.url}/", "cache_entries": 0})
+        results["fhir_search"], found = timed(lambda: len(ppapp.parse_fhir_patients(
+            client.iter_patients({"name": "smith"}, count=100, max_results=args.search_results, raise_errors=True)
+        )), repeat=3)
+        results["fhir_search"]["results"] = found
+        results["fhir_sync_all"], report = timed(lambda: ppapp.sync_all_patients(
+            client, max_workers=ppapp.FHIR_CONFIG["sync_workers"], rate_limit=0, batch_size=ppapp.FHIR_CONFIG["batch_size"]
+        ))
+        results["fhir_sync_all"].update(synced=report["synced"], failed=len(report["failed"]))
+        # The first incremental sync only sets the watermark; time the next one
+        ppapp.sync_changed_patients(client, chunk_size=ppapp.FHIR_CONFIG["batch_size"])
+        results["fhir_sync_changed"], report = timed(lambda: ppapp.sync_changed_patients(client, chunk_size=ppapp.FHIR_CONFIG["batch_size"]))
+        results["fhir_sync_changed"]["changed"] = report["changed"]
+
+        linked = list(ppapp.get_store().fhir_linked_rows())[:args.observation_patients]
+        results["observations_fetch"], report = timed(lambda: ppapp.sync_observations(client, linked))
+        results["observations_fetch"]["values"] = report["fetched"]
+        results["vitals_summary"], _ = timed(lambda: ppapp.vitals_summary(ppapp.get_observation_store().load()), repeat=3)
+
+        # Whole-population Bulk Data $export from the mock server, patients then observations
+        results["bulk_export"], report = timed(lambda: ppapp.bulk_import(client, ppapp.BULK_EXPORT_CONFIG))
+        results["bulk_export"].update(patients=report["Patient"], observations=report["Observation"])
+
+        results["rows_after"] = ppapp.get_store().count()
+    finally:
+        os.chdir(HERE)
+        if args.keep:
+            print(f"Kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def compare(baseline, current, threshold):
+    regressions = []
+    for size, operations in current["results"].items():
+        before = baseline.get("results", {}).get(size, {})
+        for name, result in operations.items():
+            if not isinstance(result, dict) or name not in before:
+                continue
+            old, new = before[name]["seconds"], result["seconds"]
+            ratio = new / old if old else float("inf")
+            flag = "  REGRESSION" if ratio > threshold and new - old > 0.001 else ""
+            print(f"{size:>9} {name:<32} {old:>10.4f}s {new:>10.4f}s {ratio:>6.2f}x{flag}", file=sys.stderr)
+            if flag:
+                regressions.append((size, name, ratio))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ppapp.py storage, search, import and FHIR paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--backend", choices=["csv", "parquet", "sqlite"], default="csv")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the mock FHIR server adds per request")
+    parser.add_argument("--linked", type=int, default=2000, help="patients with FHIR IDs to sync")
+    parser.add_argument("--inserts", type=int, default=100, help="single-row inserts for add_patient")
+    parser.add_argument("--search-results", type=int, default=1000)
+    parser.add_argument("--observation-patients", type=int, default=500)
+    parser.add_argument("--output", help="write the JSON results here as well as to stdout")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio reported as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directories")
+    args = parser.parse_args()
+
+    # Streamlit logs a warning for every st.* call made outside `streamlit run`
+    logging.disable(logging.WARNING)
+    # The app's own status prints go to stderr so stdout stays valid JSON
+    quiet = contextlib.redirect_stdout(sys.stderr)
+    quiet.__enter__()
+    scratch = tempfile.mkdtemp(prefix="ppapp-bench-")
+    os.chdir(scratch)
+    import ppapp
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    server = MockFHIRServer(patients=max(args.linked, 10000), latency=args.latency).start()
+    commit, dirty = git_commit()
+    output = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "fhir_latency": args.latency,
+        "results": {}
+    }
+    try:
+        for size in args.sizes:
+            print(f"Running {size:,} rows ({args.backend})...", file=sys.stderr)
+            output["results"][str(size)] = bench_size(ppapp, size, args, server)
+    finally:
+        server.stop()
+        quiet.__exit__(None, None, None)
+
+    print(json.dumps(output, indent=2, default=str))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, default=str)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), output, args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -2,49 +2,44 @@ import streamlit as st
 import pandas as pd
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from datetime import datetime
+import csv
+from datetime import datetime, timedelta, timezone
 import base64
-from urllib.parse import urlencode
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import urlencode, quote
 import time
+import threading
+import asyncio
+import sqlite3
+import bisect
+import cProfile
+import functools
+import io
+import pstats
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from array import array
+from collections import OrderedDict, defaultdict, deque
+import numpy as np
 
-import pandas as pd
-import os
-
-DATA_FILE = "patients_data.csv"
-
-def auto_fix_csv():
-    required_columns = [
-        "Name", "Age", "Gender", "Contact",
-        "Blood Type", "Allergies", "Medical History",
-        "FHIR_Patient_ID", "Last_Sync", "Source"
-    ]
-
-    if os.path.exists(DATA_FILE):
-        df = pd.read_csv(DATA_FILE)
-
-        # Add any missing columns with empty values
-        for col in required_columns:
-            if col not in df.columns:
-                df[col] = ""
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as pa_ds
+    import pyarrow.fs as pa_fs
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for the Parquet storage backend
+    pa = None
 
-        # Reorder columns
-        df = df[required_columns]
+try:
+    from orjson import loads as json_loads
+except ImportError:  # optional faster decoder for FHIR Bundles and NDJSON
+    json_loads = json.loads
 
-        # Save back the fixed file
-        df.to_csv(DATA_FILE, index=False)
-        print("✅ CSV file fixed successfully.")
-    else:
-        # Create a new file if it doesn't exist
-        df = pd.DataFrame(columns=required_columns)
-        df.to_csv(DATA_FILE, index=False)
-        print("✅ New CSV file created.")
-
-# Call this once when app starts
-auto_fix_csv()
-
-
-###########################
 # File to store patient data
 DATA_FILE = "patients_data.csv"
 
@@ -62,104 +57,2694 @@ FHIR_CONFIG = {
     "smart_version": "v1",
     "is_confidential": False,
     "uses_cds_hooks": False,
-    "dynamic_registration": False
+    "dynamic_registration": False,
+    "pool_size": 10,  # keep-alive connections per host
+    "timeout": (3.05, 30),  # connect / read timeout in seconds
+    "max_retries": 3,  # retries on 429 and 5xx, honouring Retry-After
+    "backoff_factor": 0.5,  # 0.5s, 1s, 2s, ... between retries
+    "sync_workers": 8,  # concurrent requests for "Sync All"
+    "sync_rate_limit": 20,  # max requests per second for "Sync All"
+    "cache_entries": 1000,  # cached GET responses (0 disables the cache)
+    "cache_ttl": 300,  # seconds before a cached response is revalidated
+    "cache_dir": "",  # keep the response cache on disk here instead of in memory
+    "batch_size": 100,  # patient IDs per _id search or batch Bundle
+    "max_url_length": 2000,  # _id searches are split to stay under this
+    "sync_clock_skew": 60  # seconds the sync watermark is held back to cover clock drift
 }
 
-# Initialize the CSV file if it doesn't exist
-if not os.path.exists(DATA_FILE):
-    df = pd.DataFrame(columns=[
-        "Name", "Age", "Gender", "Contact", 
-        "Blood Type", "Allergies", "Medical History",
-        "FHIR_Patient_ID", "Last_Sync", "Source"
-    ])
-    df.to_csv(DATA_FILE, index=False)
+PATIENT_COLUMNS = [
+    "Name", "Age", "Gender", "Contact",
+    "Blood Type", "Allergies", "Medical History",
+    "FHIR_Patient_ID", "Last_Sync", "Source"
+]
+
+# In-memory types of the patient columns. Every store read returns this schema
+# and every write is coerced to it first; blanks are "" in the text and
+# categorical columns and NA/NaT in Age and Last_Sync.
+PATIENT_SCHEMA = {
+    "Name": "string",
+    "Age": "Int16",
+    "Gender": "category",
+    "Contact": "string",
+    "Blood Type": "category",
+    "Allergies": "string",
+    "Medical History": "string",
+    "FHIR_Patient_ID": "string",
+    "Last_Sync": "datetime64",
+    "Source": "category"
+}
+LAST_SYNC_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Patient storage configuration
+STORAGE_CONFIG = {
+    "backend": "csv",  # "csv", "parquet" (needs pyarrow) or "sqlite"; others migrate the CSV on first use
+    "data_file": DATA_FILE,
+    "parquet_dir": "patients_data.parquet",
+    "sqlite_file": "patients_data.db",
+    "journal_file": "patients_data.journal.csv",
+    "meta_file": "patients_data.meta.json",
+    "fhir_index_file": "patients_data.fhir_index.csv",
+    "compact_threshold": 1000,  # journal rows before updates are folded back into the main data
+    "cache_entries": 4,  # parsed tables kept in memory across reruns
+    "cache_max_mb": 512,  # tables larger than this are never cached
+    "observations_file": "observations_data.parquet"  # written as CSV instead when pyarrow is missing
+}
+
+# Hospital ingestion endpoint (POST /api/patients) configuration
+INGEST_CONFIG = {
+    "host": "127.0.0.1",
+    "port": 8502,
+    "batch_size": 500,  # queued patients that trigger an immediate store write
+    "flush_interval": 0.25,  # seconds a partial batch may wait before it is written
+    "max_queue": 100000,  # patients held in memory before POSTs get 503
+    "max_body_mb": 16
+}
+
+# Duplicate detection for imported patients
+DEDUP_CONFIG = {
+    "enabled": True,
+    "match_keys": [["FHIR_Patient_ID"], ["Name", "Contact"]],  # blocking keys in priority order; blank parts never match
+    "on_match": "update"  # "update" fills the stored row with incoming non-blank values, "skip" leaves it alone
+}
+
+# Webhook event pipeline configuration
+WEBHOOK_CONFIG = {
+    "event_log": "webhook_events.jsonl",  # durable, replayable log of every accepted event
+    "debounce": 2.0,  # seconds a patient must be quiet before its updates are applied
+    "max_batch": 500,  # patients applied per store write
+    "poll_interval": 0.5,
+    "log_keep": 1000  # applied events kept in the log (for Webhook Logs) when it is compacted
+}
+
+# FHIR Bulk Data ($export) import configuration
+BULK_EXPORT_CONFIG = {
+    "resource_types": ["Patient", "Observation"],
+    "batch_rows": 20000,  # NDJSON lines parsed and written per store batch
+    "poll_interval": 5.0,  # seconds between status checks when the server sends no Retry-After
+    "max_wait": 3600,  # seconds to wait for the server to finish the export
+    "checkpoint_file": "bulk_export_checkpoint.json"  # job and per-file progress, for resuming
+}
+
+# Latency, payload and error metrics for pages, store operations and FHIR calls
+METRICS_CONFIG = {
+    "enabled": True,
+    "buckets": [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],  # histogram bounds in seconds
+    "payload_units": {"store": "rows", "fhir": "bytes"},
+    "profile_rows": 25  # functions listed by the per-rerun profiler
+}
+
+class Metrics:
+    # Process-wide latency histograms keyed by (kind, operation), e.g.
+    # ("store", "load") or ("fhir", "GET Patient"). Only the outermost span of
+    # each kind on a thread is recorded, so a store call made inside another
+    # store call counts towards the outer one instead of twice.
+    def __init__(self, config):
+        self.config = config
+        self.bounds = tuple(config["buckets"])
+        self.series = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def observe(self, kind, name, seconds, payload=0, error=False):
+        with self.lock:
+            series = self.series.get((kind, name))
+            if series is None:
+                series = self.series[(kind, name)] = {
+                    "buckets": [0] * (len(self.bounds) + 1), "count": 0, "sum": 0.0, "max": 0.0, "errors": 0, "payload": 0
+                }
+            series["buckets"][bisect.bisect_left(self.bounds, seconds)] += 1
+            series["count"] += 1
+            series["sum"] += seconds
+            series["max"] = max(series["max"], seconds)
+            series["errors"] += bool(error)
+            series["payload"] += payload
+
+    @contextmanager
+    def span(self, kind, name):
+        # The caller may set span["payload"] and span["error"] before it closes
+        span = {"payload": 0, "error": False}
+        active = getattr(self._local, "active", None)
+        if active is None:
+            active = self._local.active = set()
+        if not self.config["enabled"] or kind in active:
+            yield span
+            return
+        active.add(kind)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception:
+            span["error"] = True
+            raise
+        finally:
+            active.discard(kind)
+            self.observe(kind, name, time.perf_counter() - start, span["payload"], span["error"])
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+            self.started = time.time()
+
+    def _copy(self):
+        with self.lock:
+            return sorted((key, dict(series, buckets=list(series["buckets"]))) for key, series in self.series.items())
+
+    def _quantile(self, series, q):
+        # Interpolated within the bucket, like Prometheus' histogram_quantile
+        rank, seen = q * series["count"], 0
+        for i, n in enumerate(series["buckets"]):
+            if n and seen + n >= rank:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = min(self.bounds[i], series["max"]) if i < len(self.bounds) else series["max"]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return series["max"]
+
+    def snapshot(self):
+        units = self.config["payload_units"]
+        columns = ["Kind", "Operation", "Calls", "Errors", "Mean ms", "p50 ms", "p95 ms", "p99 ms", "Max ms", "Total s", "Payload", "Unit"]
+        rows = [[
+            kind, name, series["count"], series["errors"],
+            1000 * series["sum"] / series["count"],
+            1000 * self._quantile(series, 0.5), 1000 * self._quantile(series, 0.95), 1000 * self._quantile(series, 0.99),
+            1000 * series["max"], series["sum"], series["payload"], units.get(kind, "")
+        ] for (kind, name), series in self._copy()]
+        return pd.DataFrame(rows, columns=columns).sort_values("Total s", ascending=False, ignore_index=True)
+
+    def prometheus(self):
+        # Prometheus text exposition format (version 0.0.4)
+        series = self._copy()
+        lines = []
+        for kind in sorted({kind for (kind, _), _ in series}):
+            of_kind = [(_prometheus_label(name), s) for (k, name), s in series if k == kind]
+            metric = f"ppapp_{kind}_duration_seconds"
+            lines += [f"# HELP {metric} Latency of {kind} operations.", f"# TYPE {metric} histogram"]
+            for labels, s in of_kind:
+                cumulative = 0
+                for bound, n in zip(self.bounds + (None,), s["buckets"]):
+                    cumulative += n
+                    le = "+Inf" if bound is None else f"{bound:g}"
+                    lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"{metric}_sum{{{labels}}} {s['sum']:.6f}")
+                lines.append(f"{metric}_count{{{labels}}} {s['count']}")
+            metric = f"ppapp_{kind}_errors_total"
+            lines += [f"# HELP {metric} Failed {kind} operations.", f"# TYPE {metric} counter"]
+            lines += [f"{metric}{{{labels}}} {s['errors']}" for labels, s in of_kind]
+            unit = self.config["payload_units"].get(kind)
+            if unit:
+                metric = f"ppapp_{kind}_payload_{unit}_total"
+                lines += [f"# HELP {metric} {unit.capitalize()} moved by {kind} operations.", f"# TYPE {metric} counter"]
+                lines += [f"{metric}{{{labels}}} {s['payload']}" for labels, s in of_kind]
+        return "\n".join(lines) + "\n"
+
+def _prometheus_label(name):
+    escaped = name.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'operation="{escaped}"'
+
+# Shared by every rerun, the ingestion thread and the webhook worker
+@st.cache_resource
+def get_metrics():
+    return Metrics(METRICS_CONFIG)
+
+metrics = get_metrics()
+
+def instrumented(kind, payload=None):
+    # Records a span named after the decorated function; payload(result, args)
+    # gives the payload size to add
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with metrics.span(kind, fn.__name__) as span:
+                result = fn(*args, **kwargs)
+                if payload is not None:
+                    span["payload"] = payload(result, args)
+                return result
+        return wrapper
+    return decorate
+
+def _frame_rows(result, args):
+    # Rows read (a returned DataFrame) or written (a DataFrame argument)
+    for value in (result, *(result if isinstance(result, tuple) else ()), *args):
+        if isinstance(value, pd.DataFrame):
+            return len(value)
+    return 0
+
+timed_store = instrumented("store", _frame_rows)
+
+def normalize_fhir_id(value):
+    if value is None or pd.isna(value):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    value = str(value).strip()
+    # The original app saved numeric IDs as floats, so older files hold "123.0"
+    if value.endswith(".0") and value[:-2].isdigit():
+        value = value[:-2]
+    return value
+
+class NameSearchIndex:
+    # Case-folded trigram postings over the Name column. Postings only grow, so
+    # rows that were renamed keep stale entries; those rows are tracked and
+    # always re-checked against their current folded name.
+    def __init__(self, names=()):
+        self.names = []
+        self.postings = defaultdict(lambda: array("q"))
+        self.updated_rows = set()
+        self._unsorted = set()
+        self.add(range(len(names)), names)
+
+    @staticmethod
+    def _fold(name):
+        if isinstance(name, str):
+            return name.casefold()
+        return "" if name is None or pd.isna(name) else str(name).casefold()
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, positions, names):
+        postings = self.postings
+        for row, name in zip(positions, names):
+            folded = self._fold(name)
+            if row < len(self.names):
+                self.names[row] = folded
+                self.updated_rows.add(row)
+                self._unsorted.update(self._trigrams(f"  {folded} "))
+            else:
+                self.names.extend([""] * (row - len(self.names)))
+                self.names.append(folded)
+            padded = f"  {folded} "
+            for gram in {padded[i:i + 3] for i in range(len(padded) - 2)}:
+                postings[gram].append(row)
+
+    def _postings(self, gram):
+        if gram not in self.postings:
+            return np.empty(0, dtype=np.int64)
+        if gram in self._unsorted:
+            self.postings[gram] = array("q", np.unique(np.frombuffer(self.postings[gram], dtype=np.int64)).tobytes())
+            self._unsorted.discard(gram)
+        return np.frombuffer(self.postings[gram], dtype=np.int64)
+
+    def search(self, query, prefix=False, fuzzy=False, min_similarity=0.5):
+        query = self._fold(query).strip()
+        if not query:
+            return list(range(len(self.names)))
+        if fuzzy:
+            return self._fuzzy_search(query, min_similarity)
+
+        grams = self._trigrams(query)
+        if not grams:
+            # One or two characters: too short for trigrams, scan the folded names
+            candidates = range(len(self.names))
+        else:
+            # Start from the rarest trigram and narrow with binary searches
+            lists = sorted((self._postings(gram) for gram in grams), key=len)
+            candidates = lists[0]
+            for rows in lists[1:]:
+                if len(candidates) == 0:
+                    break
+                found = np.searchsorted(rows, candidates)
+                candidates = candidates[rows[np.minimum(found, len(rows) - 1)] == candidates]
+            # A single trigram hit is already an exact substring match
+            if len(grams) == 1 and "  " not in query and not prefix and not self.updated_rows:
+                return candidates.tolist()
+
+        if prefix:
+            return [int(row) for row in candidates if self.names[row].startswith(query)]
+        return [int(row) for row in candidates if query in self.names[row]]
+
+    def _fuzzy_search(self, query, min_similarity):
+        # Rank rows by the share of the query's trigrams their name contains
+        grams = self._trigrams(f"  {query} ")
+        lists = [self._postings(gram) for gram in grams if gram in self.postings]
+        if not lists:
+            return []
+        rows, hits = np.unique(np.concatenate(lists), return_counts=True)
+        scored = []
+        for row in rows[hits >= max(1, min_similarity * len(grams))]:
+            score = len(grams & self._trigrams(f"  {self.names[row]} ")) / len(grams)
+            if score >= min_similarity:
+                scored.append((score, int(row)))
+        scored.sort(key=lambda item: -item[0])
+        return [row for _, row in scored]
+
+def _typed_column(column, values):
+    kind = PATIENT_SCHEMA[column]
+    if kind == "Int16":
+        if values.dtype == "Int16":
+            return values
+        try:
+            numbers = values.mask(values == "").astype("Float64")
+        except (TypeError, ValueError):
+            # Stray text; to_numeric is several times slower but blanks it out
+            numbers = pd.to_numeric(values, errors="coerce")
+        numbers = numbers.round()
+        return numbers.where(numbers.abs() < 2 ** 15).astype("Int16")
+    if kind == "datetime64":
+        if values.dtype.kind == "M" and values.dt.tz is None:
+            return values
+        try:
+            parsed = pd.to_datetime(values, format="ISO8601", errors="coerce")
+        except (TypeError, ValueError):
+            # Naive and offset timestamps mixed together
+            parsed = pd.to_datetime(values, format="ISO8601", errors="coerce", utc=True)
+        return parsed.dt.tz_convert(None) if parsed.dt.tz is not None else parsed
+    # "string" is the NA-backed StringDtype, not pandas 3's NaN-backed "str"
+    if values.dtype != (pd.StringDtype() if kind == "string" else kind) or values.isna().any():
+        values = values.astype("string").fillna("")
+        if kind == "category":
+            values = values.astype("category")
+    if column == "FHIR_Patient_ID":
+        # Float-looking IDs from older files ("123.0") are read back as normalize_fhir_id gives them
+        legacy = values.str.endswith(".0")
+        if legacy.any():
+            values = values.where(~legacy, values.str.replace(r"^(\d+)\.0$", r"\1", regex=True))
+    return values
+
+def typed_patients(df):
+    # Coerce whichever patient columns df has to PATIENT_SCHEMA
+    columns = [column for column in df.columns if column in PATIENT_SCHEMA]
+    return df.assign(**{column: _typed_column(column, df[column]) for column in columns}) if columns else df
+
+def _file_identity(path):
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (info.st_ino, info.st_size, info.st_mtime_ns)
+
+def _append_csv(path, df):
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    df.to_csv(path, mode="a", header=write_header, index=False, date_format=LAST_SYNC_FORMAT)
+
+def _replace_csv(path, df):
+    tmp_path = f"{path}.tmp"
+    df.to_csv(tmp_path, index=False, date_format=LAST_SYNC_FORMAT)
+    os.replace(tmp_path, path)
+
+def migrate_patient_csv(path):
+    # Brings a patients CSV from an older version of the app to the
+    # PATIENT_COLUMNS layout (missing columns added empty, extra ones dropped).
+    # Only the header is read unless something actually has to change.
+    if not os.path.exists(path):
+        return False
+    with open(path, newline="") as f:
+        header = next(csv.reader(f), [])
+    if header == PATIENT_COLUMNS:
+        return False
+    if not header:
+        df = pd.DataFrame(columns=PATIENT_COLUMNS)
+    else:
+        df = pd.read_csv(path, dtype=str, keep_default_na=False).reindex(columns=PATIENT_COLUMNS, fill_value="")
+    _replace_csv(path, df)
+    print("✅ Patient data migrated to the current column layout.")
+    return True
+
+_FILTER_OPS = {
+    "==": lambda s, v: s == v,
+    "!=": lambda s, v: s != v,
+    "<": lambda s, v: s < v,
+    "<=": lambda s, v: s <= v,
+    ">": lambda s, v: s > v,
+    ">=": lambda s, v: s >= v,
+    "in": lambda s, v: s.isin(v),
+    "not in": lambda s, v: ~s.isin(v)
+}
+
+def apply_filters(df, filters):
+    # filters are (column, op, value) tuples ANDed together, as in pyarrow/pandas
+    # read_parquet; "_row" filters on the row position (the frame's index).
+    if not filters:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        values = df.index.to_series() if column == "_row" else df[column]
+        # NA compares as neither true nor false; such rows never match
+        mask &= np.asarray(_FILTER_OPS[op](values, value).fillna(False), dtype=bool)
+    return df[mask]
+
+def _filter_columns(filters):
+    return [column for column, _, _ in filters or () if column != "_row"]
+
+# Dashboard aggregates kept alongside the data and adjusted by every write, so
+# the metrics are read without scanning the patient table.
+AGGREGATE_COLUMNS = ["Source", "Gender", "Blood Type"]
+RECENT_INGESTS = 20
+
+def _new_aggregates(df, previous=None):
+    previous = previous or {}
+    aggregates = {
+        "total": 0,
+        "counts": {column: {} for column in AGGREGATE_COLUMNS},
+        "last_ingest": previous.get("last_ingest", {}),
+        "recent": previous.get("recent", [])
+    }
+    _apply_counts(aggregates, df, 1)
+    return aggregates
+
+def _apply_counts(aggregates, df, sign):
+    aggregates["total"] += sign * len(df)
+    for column in AGGREGATE_COLUMNS:
+        totals = aggregates["counts"].setdefault(column, {})
+        for value, n in _value_counts(df[column]):
+            totals[value] = totals.get(value, 0) + sign * n
+            if totals[value] <= 0:
+                del totals[value]
+
+def _value_counts(values):
+    # (value, count) pairs with blanks counted as ""; categoricals skip unused categories
+    counts = defaultdict(int)
+    for value, n in values.value_counts(dropna=False).items():
+        if n:
+            counts["" if pd.isna(value) else str(value)] += int(n)
+    return counts.items()
+
+def _record_ingest(aggregates, df):
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    for source, n in _value_counts(df["Source"]):
+        aggregates["last_ingest"][source] = now
+        aggregates["recent"].append({"time": now, "source": source, "rows": int(n)})
+    del aggregates["recent"][:-RECENT_INGESTS]
+
+# Everything is read as text; typed_patients then parses it
+CSV_DTYPES = {column: "string" for column in PATIENT_COLUMNS}
+
+class CSVBackend:
+    # New patients are appended to the end of the data file. Updates to existing
+    # rows are appended to a small journal keyed by row position, replayed on
+    # read and folded back into the data file on compaction.
+    def __init__(self, config):
+        self.data_file = config["data_file"]
+        self.journal_file = config["journal_file"]
+        if not os.path.exists(self.data_file):
+            pd.DataFrame(columns=PATIENT_COLUMNS).to_csv(self.data_file, index=False)
+        self.journal_rows = self._count_journal_rows()
+
+    def _count_journal_rows(self):
+        if not os.path.exists(self.journal_file):
+            return 0
+        with open(self.journal_file, "rb") as f:
+            return max(sum(1 for _ in f) - 1, 0)
+
+    def files(self):
+        return [self.data_file, self.journal_file]
+
+    def read(self, columns=None, filters=None):
+        usecols = None
+        if columns is not None:
+            usecols = list(dict.fromkeys(list(columns) + _filter_columns(filters)))
+        df = pd.read_csv(self.data_file, usecols=usecols, dtype=CSV_DTYPES, keep_default_na=False)
+        if os.path.exists(self.journal_file):
+            journal = pd.read_csv(self.journal_file, usecols=None if usecols is None else ["_row"] + usecols,
+                                  dtype=CSV_DTYPES, keep_default_na=False)
+            journal = journal.drop_duplicates("_row", keep="last").set_index("_row")
+            journal = journal[(journal.index >= 0) & (journal.index < len(df))]
+            journal.index.name = None
+            df = pd.concat([df.drop(index=journal.index), journal[df.columns]]).sort_index(kind="stable")
+        df = apply_filters(typed_patients(df), filters)
+        return df if columns is None else df[list(columns)]
+
+    def write(self, df):
+        _replace_csv(self.data_file, df)
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        self.journal_rows = 0
+
+    def append(self, df, positions):
+        _append_csv(self.data_file, df)
+
+    def update(self, df, positions):
+        journal = df.copy()
+        journal.insert(0, "_row", list(positions))
+        _append_csv(self.journal_file, journal)
+        self.journal_rows += len(journal)
+
+    def needs_compaction(self, threshold):
+        return self.journal_rows >= threshold
+
+class ParquetBackend:
+    # Columnar copy of the patient table: one Parquet part per append and one
+    # journal part per update, each carrying a _row position column so filters
+    # can be pushed down to the files. Compaction rewrites everything as a
+    # single part. Parts are read through memory maps.
+    MAX_PARTS = 64
+
+    def __init__(self, config):
+        self.directory = config["parquet_dir"]
+        os.makedirs(self.directory, exist_ok=True)
+        self.schema = pa.schema(
+            [("_row", pa.int64())] +
+            [(column, pa.float64() if column == "Age" else pa.string()) for column in PATIENT_COLUMNS]
+        )
+        self.filesystem = pa_fs.LocalFileSystem(use_mmap=True)
+        if not self._parts("part-"):
+            self.write(pd.DataFrame(columns=PATIENT_COLUMNS))
+
+    def _parts(self, prefix):
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name.endswith(".parquet")
+        )
+
+    def _next_path(self, prefix):
+        return os.path.join(self.directory, f"{prefix}{time.time_ns():020d}.parquet")
+
+    @property
+    def journal_rows(self):
+        parts = self._parts("journal-")
+        return sum(pq.ParquetFile(path).metadata.num_rows for path in parts) if parts else 0
+
+    def _to_table(self, df, positions):
+        # The files keep the original float/string layout; the schema is applied on read
+        df = typed_patients(df.reindex(columns=PATIENT_COLUMNS))
+        df["Age"] = df["Age"].astype("float64")
+        df["Last_Sync"] = df["Last_Sync"].dt.strftime(LAST_SYNC_FORMAT)
+        for column in PATIENT_COLUMNS:
+            if column != "Age":
+                df[column] = df[column].astype("string")
+        df.insert(0, "_row", np.asarray(list(positions), dtype=np.int64))
+        return pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+
+    def _write_table(self, table, path):
+        tmp_path = f"{path}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def files(self):
+        return [self.directory] + self._parts("part-") + self._parts("journal-")
+
+    def read(self, columns=None, filters=None):
+        names = PATIENT_COLUMNS if columns is None else list(dict.fromkeys(list(columns) + _filter_columns(filters)))
+        expression = pq.filters_to_expression(filters) if filters else None
+
+        journal = None
+        if self._parts("journal-"):
+            journal = pq.read_table(self._parts("journal-"), columns=["_row"] + names, memory_map=True).to_pandas()
+            journal = journal.drop_duplicates("_row", keep="last").set_index("_row")
+            journal.index.name = None
+            # Rows with a newer journal entry are taken from the journal instead
+            base_filter = ~pc.field("_row").isin(pa.array(journal.index.to_numpy(), pa.int64()))
+            expression = base_filter if expression is None else expression & base_filter
+
+        dataset = pa_ds.dataset(self._parts("part-"), schema=self.schema, format="parquet", filesystem=self.filesystem)
+        df = dataset.to_table(columns=["_row"] + names, filter=expression).to_pandas()
+        df = df.set_index("_row")
+        df.index.name = None
+        if journal is not None:
+            df = pd.concat([df, apply_filters(journal, filters)])
+        df = typed_patients(df.sort_index(kind="stable"))
+        return df if columns is None else df[list(columns)]
+
+    def write(self, df):
+        old_parts = self._parts("part-") + self._parts("journal-")
+        path = self._next_path("part-")
+        self._write_table(self._to_table(df, range(len(df))), path)
+        for part in old_parts:
+            os.remove(part)
+
+    def append(self, df, positions):
+        self._write_table(self._to_table(df, positions), self._next_path("part-"))
+
+    def update(self, df, positions):
+        self._write_table(self._to_table(df, positions), self._next_path("journal-"))
+
+    def needs_compaction(self, threshold):
+        return (len(self._parts("part-")) + len(self._parts("journal-")) > self.MAX_PARTS
+                or self.journal_rows >= threshold)
+
+def make_backend(config):
+    if config.get("backend") == "parquet":
+        if pa is None:
+            print("⚠️ pyarrow is not installed, falling back to CSV storage.")
+        else:
+            migrate = not os.path.isdir(config["parquet_dir"]) and os.path.exists(config["data_file"])
+            backend = ParquetBackend(config)
+            if migrate:
+                # One-time migration of the existing CSV table
+                backend.write(CSVBackend(config).read())
+                print("✅ Patient data migrated from CSV to Parquet.")
+            return backend
+    return CSVBackend(config)
+
+def _patched_frame(full, positions, patients):
+    # The cached table with typed patients written at positions (new rows go
+    # past the end), equal to what re-reading the files would give
+    patients = patients.set_axis(pd.Index(list(positions), dtype="int64"))
+    patients = patients.assign(Last_Sync=patients["Last_Sync"].dt.floor("s"))  # stored as LAST_SYNC_FORMAT
+    new = np.asarray(patients.index >= len(full))
+    columns = {}
+    for column in full.columns:
+        values, incoming = full[column], patients[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.cat.categories.union(incoming.astype(str).unique())
+            values = values.cat.set_categories(categories)
+            incoming = incoming.astype(str).astype(values.dtype)
+        if not new.all():
+            values = values.copy()
+            values.loc[incoming.index[~new]] = incoming[~new]
+        if new.any():
+            values = pd.concat([values, incoming[new]])
+        columns[column] = values
+    return pd.DataFrame(columns)
+
+class PatientStore:
+    # Storage-independent layer over a backend: the parsed-table cache, row
+    # positions and the secondary indexes.
+    #
+    # The FHIR_Patient_ID -> row index is persisted as an append-only log next
+    # to the data. The meta file records the identity of every file as of our
+    # last write, so the index and row count are only rebuilt from the data
+    # when something else has touched the files since.
+    def __init__(self, config, backend):
+        self.config = config
+        self.backend = backend
+        self.meta_file = config["meta_file"]
+        self.index_file = config["fhir_index_file"]
+        self.meta = {}
+        self.row_count = 0
+        self._fhir_index = None
+        self._fhir_rows = {}
+        self._name_index = None
+        self._aggregate_rows = None
+        self._last_match = (None, None)
+        self._patches = None
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+
+    def identity(self):
+        return tuple(map(_file_identity, self.backend.files()))
+
+    def _tracked_identity(self):
+        files = self.backend.files() + [self.index_file]
+        return [list(identity) if identity else None for identity in map(_file_identity, files)]
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_meta(self):
+        self.meta["rows"] = self.row_count
+        self.meta["identity"] = self._tracked_identity()
+        tmp_path = f"{self.meta_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_file)
+
+    def _ensure_state(self):
+        identity = self._tracked_identity()
+        if self._fhir_index is not None and self.meta.get("identity") == identity:
+            return
+        self._name_index = None
+        self._aggregate_rows = None
+        self.meta = self._read_meta()
+        if self.meta.get("identity") == identity and "rows" in self.meta:
+            self.row_count = self.meta["rows"]
+            self._load_index()
+            if "aggregates" not in self.meta:
+                self.meta["aggregates"] = _new_aggregates(self.load(AGGREGATE_COLUMNS))
+                self._write_meta()
+        else:
+            df = self.load()
+            self.row_count = len(df)
+            self._rebuild_index(df)
+            self.meta["aggregates"] = _new_aggregates(df, self.meta.get("aggregates"))
+            self._write_meta()
+
+    def _load_index(self):
+        self._fhir_index = {}
+        if os.path.exists(self.index_file):
+            entries = pd.read_csv(self.index_file, dtype={"FHIR_Patient_ID": str})
+            for fhir_id, row in zip(entries["FHIR_Patient_ID"], entries["_row"]):
+                if row < 0:
+                    self._fhir_index.pop(fhir_id, None)
+                else:
+                    self._fhir_index[fhir_id] = int(row)
+        self._fhir_rows = {row: fhir_id for fhir_id, row in self._fhir_index.items()}
 
-def load_data():
-    return pd.read_csv(DATA_FILE)
+    def _rebuild_index(self, df):
+        ids = pd.Series(df["FHIR_Patient_ID"].map(normalize_fhir_id).to_numpy())
+        linked = ids[(ids != "") & ~ids.duplicated()]
+        self._fhir_index = dict(zip(linked, linked.index))
+        self._fhir_rows = dict(zip(linked.index, linked))
+        entries = pd.DataFrame({"FHIR_Patient_ID": linked.to_numpy(), "_row": linked.index})
+        _replace_csv(self.index_file, entries)
+
+    def _index_rows(self, positions, fhir_ids):
+        # Called after the rows are written. Keeps the index what _rebuild_index
+        # would give: every ID points at the first row that carries it.
+        changes, orphaned = [], set()
+        for row, fhir_id in zip(positions, fhir_ids):
+            fhir_id = normalize_fhir_id(fhir_id)
+            old_id = self._fhir_rows.get(row)
+            if old_id == fhir_id:
+                continue
+            if old_id is not None:
+                del self._fhir_index[old_id]
+                del self._fhir_rows[row]
+                orphaned.add(old_id)
+            holder = self._fhir_index.get(fhir_id)
+            if fhir_id and (holder is None or row < holder):
+                if holder is not None:
+                    del self._fhir_rows[holder]
+                self._fhir_index[fhir_id] = row
+                self._fhir_rows[row] = fhir_id
+                changes.append((fhir_id, row))
+        if orphaned:
+            # Rows outside this write may still carry an ID that was moved off
+            # its row; only relinks get here, so reading the column is rare
+            carriers = self.load(["FHIR_Patient_ID"])["FHIR_Patient_ID"].map(normalize_fhir_id)
+            carriers = carriers[carriers.isin(orphaned)]
+            first = carriers[~carriers.duplicated()]
+            for fhir_id in orphaned:
+                row = int(first.index[first == fhir_id][0]) if (first == fhir_id).any() else None
+                holder = self._fhir_index.pop(fhir_id, None)
+                if holder is not None:
+                    del self._fhir_rows[holder]
+                if row is None:
+                    changes.append((fhir_id, -1))
+                else:
+                    self._fhir_index[fhir_id] = row
+                    self._fhir_rows[row] = fhir_id
+                    changes.append((fhir_id, row))
+        if changes:
+            _append_csv(self.index_file, pd.DataFrame(changes, columns=["FHIR_Patient_ID", "_row"]))
+
+    def find_by_fhir_id(self, fhir_id):
+        with self._write_lock:
+            self._ensure_state()
+            return self._fhir_index.get(normalize_fhir_id(fhir_id))
+
+    def fhir_linked_rows(self):
+        with self._write_lock:
+            self._ensure_state()
+            return dict(self._fhir_index)
+
+    def get_meta(self, key, default=None):
+        with self._write_lock:
+            self._ensure_state()
+            return self.meta.get(key, default)
+
+    def set_meta(self, key, value):
+        with self._write_lock:
+            self._ensure_state()
+            self.meta[key] = value
+            self._write_meta()
+
+    @timed_store
+    def aggregates(self):
+        with self._write_lock:
+            self._ensure_state()
+            return json.loads(json.dumps(self.meta["aggregates"]))
+
+    def _aggregate_values(self, df):
+        return {column: df[column].astype(object).where(df[column].notna(), "").tolist() for column in AGGREGATE_COLUMNS}
+
+    def _previous_aggregates(self, positions):
+        # Old Source/Gender/Blood Type of rows about to be updated, from a
+        # projection read once and then kept current by our own writes
+        if self._aggregate_rows is None:
+            self._aggregate_rows = self._aggregate_values(self.load(AGGREGATE_COLUMNS))
+        return pd.DataFrame({column: [values[row] for row in positions] for column, values in self._aggregate_rows.items()},
+                            columns=AGGREGATE_COLUMNS)
+
+    @timed_store
+    def search_names(self, query, prefix=False, fuzzy=False):
+        with self._write_lock:
+            self._ensure_state()
+            if self._name_index is None:
+                self._name_index = NameSearchIndex(self.load()["Name"].tolist())
+            return self._name_index.search(query, prefix=prefix, fuzzy=fuzzy)
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            df = self._cache.get(key)
+            if df is not None:
+                self._cache.move_to_end(key)
+            return df
+
+    def _cache_put(self, key, df):
+        if df.memory_usage(deep=True).sum() > self.config["cache_max_mb"] * 1024 * 1024:
+            return
+        with self._cache_lock:
+            self._cache[key] = df
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.config["cache_entries"]:
+                self._cache.popitem(last=False)
+
+    def invalidate(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self._last_match = (None, None)
+            self._patches = None
+
+    # Our own writes do not throw the parsed table away: the table from before
+    # them is kept with the written rows, and the next full read applies them
+    # all in one in-memory pass instead of re-parsing the files.
+    def _patch_base(self):
+        identity = self.identity()
+        full = self._cache_get((identity, None, None))
+        if full is not None and len(full) == self.row_count:
+            return full, []
+        with self._cache_lock:
+            if self._patches is not None and self._patches[0] == identity:
+                return self._patches[1], self._patches[2]
+        return None
+
+    def _queue_patch(self, base, positions, patients):
+        if base is not None:
+            with self._cache_lock:
+                self._patches = (self.identity(), base[0], base[1] + [(list(positions), patients)])
+
+    def _patched_table(self, identity):
+        with self._cache_lock:
+            patches, self._patches = self._patches, None
+        if patches is None or patches[0] != identity:
+            return None
+        _, full, writes = patches
+        positions = [row for rows, _ in writes for row in rows]
+        patients = pd.concat([df for _, df in writes], ignore_index=True).set_axis(positions)
+        patients = patients[~patients.index.duplicated(keep="last")].sort_index()
+        df = _patched_frame(full, patients.index, patients)
+        self._cache_put((identity, None, None), df)
+        return df
+
+    @timed_store
+    def load(self, columns=None, filters=None):
+        identity = self.identity()
+        key = (identity, None if columns is None else tuple(columns), repr(filters) if filters else None)
+        df = self._cache_get(key)
+        if df is None:
+            full = self._cache_get((identity, None, None))
+            if full is None:
+                full = self._patched_table(identity)
+            if full is not None:
+                df = apply_filters(full, filters)
+                df = df if columns is None else df[list(columns)]
+            else:
+                df = self._read(columns, filters)
+                self._cache_put(key, df)
+        return df.copy()
+
+    def _read(self, columns, filters):
+        return self.backend.read(columns, filters)
+
+    def _all_rows(self):
+        with self._write_lock:
+            self._ensure_state()
+            return pd.RangeIndex(self.row_count)
+
+    def _matching_rows(self, filters, name_query, fuzzy):
+        # Positions of the matching rows, in fuzzy-rank order or else row order.
+        # The last result is kept, since a page render counts and then pages the same query.
+        key = (self.identity(), repr(filters), name_query, fuzzy)
+        with self._cache_lock:
+            if self._last_match[0] == key:
+                return self._last_match[1]
+        positions = self._match(filters, name_query, fuzzy)
+        with self._cache_lock:
+            self._last_match = (key, positions)
+        return positions
+
+    def _match(self, filters, name_query, fuzzy):
+        if filters:
+            positions = self.load(_filter_columns(filters) or ["Name"], filters).index
+        else:
+            positions = self._all_rows()
+        if name_query:
+            matches = pd.Index(self.search_names(name_query, fuzzy=fuzzy))
+            positions = matches[matches.isin(positions)]
+        return positions
+
+    def _sort_keys(self, column, positions):
+        return self.load([column])[column].loc[positions]
+
+    @timed_store
+    def count(self, filters=None, name_query="", fuzzy=False):
+        return len(self._matching_rows(filters, name_query, fuzzy))
+
+    @timed_store
+    def find_page(self, filters=None, name_query="", fuzzy=False, sort_by=None, ascending=True, offset=0, limit=50, total=None):
+        # Only the rows on the requested page are materialized with all columns;
+        # total is the caller's count of the same query, when it already has one
+        positions = self._matching_rows(filters, name_query, fuzzy)
+        if sort_by:
+            keys = self._sort_keys(sort_by, positions)
+            if keys.dtype == object:
+                keys = keys.map(lambda v: v if pd.isna(v) else str(v))
+            positions = keys.sort_values(ascending=ascending, kind="stable", na_position="last").index
+        page = positions[offset:offset + limit]
+        return self.load_rows(page).loc[page], len(positions) if total is None else total
+
+    @timed_store
+    def load_rows(self, positions, columns=None):
+        return self.load(columns, [("_row", "in", sorted(positions))])
+
+    @timed_store
+    def save(self, df):
+        with self._write_lock:
+            self.invalidate()
+            df = typed_patients(df.reindex(columns=PATIENT_COLUMNS))
+            self.backend.write(df)
+            self._cache_put((self.identity(), None, None), _patched_frame(df.iloc[:0], range(len(df)), df))
+            self.row_count = len(df)
+            self._rebuild_index(df)
+            self._name_index = None
+            self._aggregate_rows = self._aggregate_values(df)
+            self.meta["aggregates"] = _new_aggregates(df, self.meta.get("aggregates"))
+            self._write_meta()
+
+    @timed_store
+    def append(self, new_patients):
+        with self._write_lock:
+            self._ensure_state()
+            base = self._patch_base()
+            self.invalidate()
+            new_patients = typed_patients(new_patients.reindex(columns=PATIENT_COLUMNS))
+            positions = range(self.row_count, self.row_count + len(new_patients))
+            self.backend.append(new_patients, positions)
+            self._queue_patch(base, positions, new_patients)
+            self.row_count += len(new_patients)
+            ids = new_patients["FHIR_Patient_ID"].map(normalize_fhir_id).to_numpy()
+            linked = ids != ""
+            self._index_rows([row for row, keep in zip(positions, linked) if keep], ids[linked])
+            if self._name_index is not None:
+                self._name_index.add(positions, new_patients["Name"])
+            if self._aggregate_rows is not None:
+                for column, values in self._aggregate_values(new_patients).items():
+                    self._aggregate_rows[column].extend(values)
+            _apply_counts(self.meta["aggregates"], new_patients, 1)
+            _record_ingest(self.meta["aggregates"], new_patients)
+            self._write_meta()
+            # Parquet writes a part per append, so appends alone can hit MAX_PARTS
+            if self.backend.needs_compaction(self.config["compact_threshold"]):
+                self.compact()
+            return positions
+
+    @timed_store
+    def update(self, positions, patients):
+        with self._write_lock:
+            self._ensure_state()
+            positions = list(positions)
+            previous = self._previous_aggregates(positions)
+            base = self._patch_base()
+            self.invalidate()
+            patients = typed_patients(patients.reindex(columns=PATIENT_COLUMNS))
+            self.backend.update(patients, positions)
+            self._queue_patch(base, positions, patients)
+            self._index_rows(positions, patients["FHIR_Patient_ID"])
+            if self._name_index is not None:
+                self._name_index.add(positions, patients["Name"])
+            for column, values in self._aggregate_values(patients).items():
+                for row, value in zip(positions, values):
+                    self._aggregate_rows[column][row] = value
+            _apply_counts(self.meta["aggregates"], previous, -1)
+            _apply_counts(self.meta["aggregates"], patients, 1)
+            self._write_meta()
+            if self.backend.needs_compaction(self.config["compact_threshold"]):
+                self.compact()
+
+    @timed_store
+    def upsert_by_fhir_id(self, patient):
+        with self._write_lock:
+            row = self.find_by_fhir_id(patient.get("FHIR_Patient_ID"))
+            if row is None:
+                return self.append(pd.DataFrame([patient]))[0], "created"
+            self.update([row], pd.DataFrame([patient]))
+            return row, "updated"
+
+    @timed_store
+    def upsert_many(self, patients):
+        # Update linked rows and append the rest; the last row wins for repeated IDs
+        with self._write_lock:
+            self._ensure_state()
+            patients = patients.reindex(columns=PATIENT_COLUMNS).reset_index(drop=True)
+            ids = patients["FHIR_Patient_ID"].map(normalize_fhir_id)
+            patients = patients[(ids == "") | ~ids.duplicated(keep="last")]
+            rows = ids[patients.index].map(self._fhir_index.get)
+            existing = rows.notna().to_numpy()
+            if existing.any():
+                self.update(rows[existing].astype(int), patients[existing])
+            if not existing.all():
+                self.append(patients[~existing])
+            return {"created": int((~existing).sum()), "updated": int(existing.sum())}
+
+    @timed_store
+    def compact(self):
+        with self._write_lock:
+            self.save(self.load())
+
+def _sql_value(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime(LAST_SYNC_FORMAT)
+    return value.item() if hasattr(value, "item") else value
+
+def _sql_where(filters):
+    clauses, params = [], []
+    for column, op, value in filters or ():
+        if column != "_row" and column not in PATIENT_COLUMNS:
+            raise ValueError(f"Unknown column in filter: {column}")
+        name = "row_pos" if column == "_row" else f'"{column}"'
+        if op in ("in", "not in"):
+            values = [_sql_value(v) for v in value]
+            placeholders = ", ".join("?" * len(values))
+            clauses.append(f"{name} {op.upper()} ({placeholders})" if values else ("0" if op == "in" else "1"))
+            params.extend(values)
+        else:
+            clauses.append(f"{name} {'=' if op == '==' else op} ?")
+            params.append(_sql_value(value))
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+class SQLitePatientStore(PatientStore):
+    # Patient table in an embedded SQLite database in WAL mode, so readers never
+    # block the single writer and several processes can share it safely. Every
+    # write is a short BEGIN IMMEDIATE transaction of single-row statements, and
+    # lookups and filters run as indexed SQL instead of through pandas. Name
+    # search uses the same in-memory trigram index as the file backends, since
+    # SQLite's NOCASE and LIKE only fold ASCII and LIKE '%...%' scans the table.
+    MAX_SQL_PARAMS = 900
+
+    def __init__(self, config):
+        super().__init__(config, backend=None)
+        self.db_file = config["sqlite_file"]
+        self._local = threading.local()
+        self._name_index_identity = None
+        self._written_names = []
+        migrate = not os.path.exists(self.db_file) and os.path.exists(config["data_file"])
+        self._create_schema()
+        if migrate:
+            self.save(CSVBackend(config).read())
+            print("✅ Patient data migrated from CSV to SQLite.")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @contextmanager
+    def _write(self):
+        # One write transaction of ours. Names it writes are added to the
+        # in-memory name index afterwards, so only writes from another process
+        # make the next name search rebuild it.
+        with self._write_lock:
+            current = self._name_index is not None and self._name_index_identity == self.identity()
+            self._written_names = []
+            with self._transaction() as conn:
+                self.invalidate()
+                yield conn
+            if current:
+                for positions, names in self._written_names:
+                    self._name_index.add(positions, names)
+                self._name_index_identity = self.identity()
+
+    def _create_schema(self):
+        columns = ", ".join(
+            f'"{column}" REAL' if column == "Age" else
+            f'"{column}" TEXT COLLATE NOCASE' if column == "Name" else
+            f'"{column}" TEXT'
+            for column in PATIENT_COLUMNS
+        )
+        with self._transaction() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS patients (row_pos INTEGER PRIMARY KEY, {columns})")
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_patients_fhir_id ON patients("FHIR_Patient_ID")')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_patients_source ON patients("Source")')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_patients_name ON patients("Name")')
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # Databases migrated from an older CSV may hold float-looking IDs ("123.0")
+            conn.execute('''UPDATE patients SET "FHIR_Patient_ID" = substr("FHIR_Patient_ID", 1, length("FHIR_Patient_ID") - 2)
+                            WHERE "FHIR_Patient_ID" LIKE '%.0' AND length("FHIR_Patient_ID") > 2
+                            AND substr("FHIR_Patient_ID", 1, length("FHIR_Patient_ID") - 2) NOT GLOB '*[^0-9]*' ''')
+
+    def identity(self):
+        return tuple(_file_identity(path) for path in (self.db_file, f"{self.db_file}-wal"))
+
+    def _rows(self, df):
+        df = typed_patients(df.reindex(columns=PATIENT_COLUMNS))
+        return [tuple(_sql_value(v) for v in row) for row in df.itertuples(index=False, name=None)]
+
+    def _read(self, columns, filters, where="", params=()):
+        names = PATIENT_COLUMNS if columns is None else list(columns)
+        # Very long IN lists are applied in pandas instead of as SQL parameters
+        pushed = [f for f in filters or () if f[1] not in ("in", "not in") or len(f[2]) <= self.MAX_SQL_PARAMS]
+        local = [f for f in filters or () if f not in pushed]
+        clause, filter_params = _sql_where(pushed)
+        if where:
+            clause = f"{clause} AND {where}" if clause else f" WHERE {where}"
+        selected = ", ".join(f'"{name}"' for name in dict.fromkeys(names + _filter_columns(local)))
+        df = pd.read_sql_query(
+            f"SELECT row_pos, {selected} FROM patients{clause} ORDER BY row_pos",
+            self._connect(), params=filter_params + list(params), index_col="row_pos"
+        )
+        df.index.name = None
+        return apply_filters(typed_patients(df), local)[names]
+
+    def _load_aggregates(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'aggregates'").fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        columns = ", ".join(f'"{column}"' for column in AGGREGATE_COLUMNS)
+        return _new_aggregates(pd.read_sql_query(f"SELECT {columns} FROM patients", conn))
+
+    def _store_aggregates(self, conn, aggregates):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('aggregates', ?)", (json.dumps(aggregates),))
+
+    def _old_values(self, conn, positions):
+        columns = ", ".join(f'"{column}"' for column in AGGREGATE_COLUMNS)
+        frames = [
+            pd.read_sql_query(
+                f"SELECT {columns} FROM patients WHERE row_pos IN ({', '.join('?' * len(chunk))})",
+                conn, params=[_sql_value(p) for p in chunk]
+            )
+            for chunk in (positions[i:i + self.MAX_SQL_PARAMS] for i in range(0, len(positions), self.MAX_SQL_PARAMS))
+        ]
+        return pd.concat(frames) if frames else pd.DataFrame(columns=AGGREGATE_COLUMNS)
+
+    @timed_store
+    def save(self, df):
+        with self._write() as conn:
+            conn.execute("DELETE FROM patients")
+            self._insert(conn, df, 0)
+            self._store_aggregates(conn, _new_aggregates(df.reindex(columns=PATIENT_COLUMNS), self._load_aggregates(conn)))
+        self._name_index = None
+
+    def _insert(self, conn, df, start):
+        placeholders = ", ".join("?" * (len(PATIENT_COLUMNS) + 1))
+        quoted = ", ".join(f'"{column}"' for column in PATIENT_COLUMNS)
+        rows = [(start + i,) + row for i, row in enumerate(self._rows(df))]
+        conn.executemany(f"INSERT INTO patients (row_pos, {quoted}) VALUES ({placeholders})", rows)
+        return range(start, start + len(rows))
+
+    def _insert_new(self, conn, df):
+        df = df.reindex(columns=PATIENT_COLUMNS)
+        aggregates = self._load_aggregates(conn)
+        positions = self._insert(conn, df, self._next_row(conn))
+        self._written_names.append((positions, df["Name"]))
+        _apply_counts(aggregates, df, 1)
+        _record_ingest(aggregates, df)
+        self._store_aggregates(conn, aggregates)
+        return positions
+
+    def _next_row(self, conn):
+        return conn.execute("SELECT COALESCE(MAX(row_pos) + 1, 0) FROM patients").fetchone()[0]
+
+    @timed_store
+    def append(self, new_patients):
+        with self._write() as conn:
+            return self._insert_new(conn, new_patients)
+
+    def _update(self, conn, positions, patients):
+        aggregates = self._load_aggregates(conn)
+        _apply_counts(aggregates, self._old_values(conn, positions), -1)
+        assignments = ", ".join(f'"{column}" = ?' for column in PATIENT_COLUMNS)
+        rows = [row + (_sql_value(position),) for row, position in zip(self._rows(patients), positions)]
+        conn.executemany(f"UPDATE patients SET {assignments} WHERE row_pos = ?", rows)
+        patients = patients.reindex(columns=PATIENT_COLUMNS)
+        self._written_names.append((positions, patients["Name"]))
+        _apply_counts(aggregates, patients, 1)
+        self._store_aggregates(conn, aggregates)
+
+    @timed_store
+    def update(self, positions, patients):
+        with self._write() as conn:
+            self._update(conn, list(positions), patients)
+
+    @timed_store
+    def upsert_by_fhir_id(self, patient):
+        fhir_id = normalize_fhir_id(patient.get("FHIR_Patient_ID"))
+        with self._write() as conn:
+            found = conn.execute(
+                'SELECT MIN(row_pos) FROM patients WHERE "FHIR_Patient_ID" = ?', (fhir_id,)
+            ).fetchone()[0] if fhir_id else None
+            if found is None:
+                return self._insert_new(conn, pd.DataFrame([patient]))[0], "created"
+            self._update(conn, [found], pd.DataFrame([patient]))
+            return found, "updated"
+
+    @timed_store
+    def upsert_many(self, patients):
+        patients = patients.reindex(columns=PATIENT_COLUMNS).reset_index(drop=True)
+        ids = patients["FHIR_Patient_ID"].map(normalize_fhir_id)
+        patients = patients[(ids == "") | ~ids.duplicated(keep="last")]
+        with self._write() as conn:
+            rows = [
+                conn.execute('SELECT MIN(row_pos) FROM patients WHERE "FHIR_Patient_ID" = ?', (fhir_id,)).fetchone()[0]
+                if fhir_id else None
+                for fhir_id in ids[patients.index]
+            ]
+            existing = np.array([row is not None for row in rows], dtype=bool)
+            if existing.any():
+                self._update(conn, [row for row in rows if row is not None], patients[existing])
+            if not existing.all():
+                self._insert_new(conn, patients[~existing])
+        return {"created": int((~existing).sum()), "updated": int(existing.sum())}
+
+    @timed_store
+    def compact(self):
+        with self._write_lock:
+            current = self._name_index is not None and self._name_index_identity == self.identity()
+            self._connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if current:
+                self._name_index_identity = self.identity()
+
+    def find_by_fhir_id(self, fhir_id):
+        fhir_id = normalize_fhir_id(fhir_id)
+        if not fhir_id:
+            return None
+        return self._connect().execute(
+            'SELECT MIN(row_pos) FROM patients WHERE "FHIR_Patient_ID" = ?', (fhir_id,)
+        ).fetchone()[0]
+
+    def fhir_linked_rows(self):
+        return dict(self._connect().execute(
+            """SELECT "FHIR_Patient_ID", MIN(row_pos) FROM patients
+               WHERE "FHIR_Patient_ID" IS NOT NULL AND "FHIR_Patient_ID" != ''
+               GROUP BY "FHIR_Patient_ID" """
+        ).fetchall())
+
+    def get_meta(self, key, default=None):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_meta(self, key, value):
+        with self._write() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    @timed_store
+    def aggregates(self):
+        aggregates = self.get_meta("aggregates")
+        if aggregates is None:
+            # Only a database created before aggregates were kept needs the one-off count
+            with self._write() as conn:
+                aggregates = self._load_aggregates(conn)
+                self._store_aggregates(conn, aggregates)
+        return aggregates
+
+    @timed_store
+    def search_names(self, query, prefix=False, fuzzy=False):
+        with self._write_lock:
+            if self._name_index is None or self._name_index_identity != self.identity():
+                # First use, or another process wrote to the database
+                self._name_index_identity = self.identity()
+                rows = self._connect().execute('SELECT row_pos, "Name" FROM patients ORDER BY row_pos').fetchall()
+                self._name_index = NameSearchIndex([])
+                self._name_index.add([row for row, _ in rows], [name for _, name in rows])
+            return self._name_index.search(query, prefix=prefix, fuzzy=fuzzy)
+
+    def _lookup(self, positions, filters=None, column=None):
+        # (row_pos[, column]) of the given rows that pass filters, by primary key in chunks
+        clause, params = _sql_where(filters)
+        clause = f"{clause} AND" if clause else " WHERE"
+        selected = f'row_pos, "{column}"' if column else "row_pos"
+        size = max(1, self.MAX_SQL_PARAMS - len(params))
+        conn, found = self._connect(), []
+        for start in range(0, len(positions), size):
+            chunk = [int(row) for row in positions[start:start + size]]
+            found += conn.execute(
+                f"SELECT {selected} FROM patients{clause} row_pos IN ({', '.join('?' * len(chunk))})", params + chunk
+            ).fetchall()
+        return found
+
+    def _match(self, filters, name_query, fuzzy):
+        # Name matches come from the index; only those rows are checked against the filters
+        matches = self.search_names(name_query, fuzzy=fuzzy)
+        if filters:
+            kept = {row for row, in self._lookup(matches, filters)}
+            matches = [row for row in matches if row in kept]
+        return pd.Index(matches, dtype="int64")
+
+    def _sort_keys(self, column, positions):
+        keys = pd.DataFrame(self._lookup(positions, column=column), columns=["row_pos", column]).set_index("row_pos")
+        keys.index.name = None
+        return typed_patients(keys)[column].reindex(positions)
+
+    @timed_store
+    def count(self, filters=None, name_query="", fuzzy=False):
+        if name_query.strip():
+            return super().count(filters, name_query, fuzzy)
+        clause, params = _sql_where(filters)
+        return self._connect().execute(f"SELECT COUNT(*) FROM patients{clause}", params).fetchone()[0]
+
+    @timed_store
+    def find_page(self, filters=None, name_query="", fuzzy=False, sort_by=None, ascending=True, offset=0, limit=50, total=None):
+        if sort_by and sort_by not in PATIENT_COLUMNS:
+            raise ValueError(f"Unknown sort column: {sort_by}")
+        if name_query.strip():
+            return super().find_page(filters, name_query, fuzzy, sort_by, ascending, offset, limit, total)
+        clause, params = _sql_where(filters)
+        order = f'"{sort_by}" {"ASC" if ascending else "DESC"}, row_pos' if sort_by else "row_pos"
+        selected = ", ".join(f'"{column}"' for column in PATIENT_COLUMNS)
+        df = pd.read_sql_query(
+            f"SELECT row_pos, {selected} FROM patients{clause} ORDER BY {order} LIMIT ? OFFSET ?",
+            self._connect(), params=params + [int(limit), int(offset)], index_col="row_pos"
+        )
+        df.index.name = None
+        return typed_patients(df), self.count(filters) if total is None else total
+
+@st.cache_resource
+def get_store():
+    # Checked once per process, before any backend reads or migrates the CSV
+    migrate_patient_csv(STORAGE_CONFIG["data_file"])
+    if STORAGE_CONFIG.get("backend") == "sqlite":
+        return SQLitePatientStore(STORAGE_CONFIG)
+    return PatientStore(STORAGE_CONFIG, make_backend(STORAGE_CONFIG))
+
+def load_data(columns=None, filters=None):
+    return get_store().load(columns, filters)
+
+def load_rows(positions, columns=None):
+    return get_store().load_rows(positions, columns)
+
+def patient_aggregates():
+    return get_store().aggregates()
+
+def _key_part(column, values):
+    if column == "FHIR_Patient_ID":
+        return values.map(normalize_fhir_id).astype(str)
+    values = values.astype(object).where(values.notna(), "").astype(str)
+    if column == "Contact":
+        return values.str.replace(r"\D", "", regex=True)
+    return values.str.replace(r"\s+", " ", regex=True).str.strip().str.casefold()
+
+def blocking_keys(df, columns):
+    # Normalized key per row, or "" when any part is blank
+    parts = [_key_part(column, df[column]) for column in columns]
+    keys = parts[0]
+    for part in parts[1:]:
+        keys = keys + "\x1f" + part
+    blank = np.logical_or.reduce([(part == "").to_numpy() for part in parts])
+    return keys.where(~blank, "")
+
+class PatientDeduplicator:
+    # Hash blocking instead of all-pairs comparison: incoming rows that share a
+    # blocking key are folded together, then each key is looked up in a
+    # key -> row map of the stored patients. The maps are built once from a
+    # projection of the key columns and kept current with our own writes; they
+    # are rebuilt only when something else changes the store.
+    def __init__(self, store, config):
+        self.store = store
+        self.config = config
+        self._maps = None
+        self._identity = None
+        self._lock = threading.Lock()
+
+    def _existing_maps(self):
+        identity = self.store.identity()
+        if self._maps is None or identity != self._identity:
+            self._maps = []
+            for columns in self.config["match_keys"]:
+                if columns == ["FHIR_Patient_ID"]:
+                    self._maps.append(self.store.fhir_linked_rows())
+                    continue
+                keys = blocking_keys(self.store.load(columns), columns)
+                keys = keys[(keys != "").to_numpy() & ~keys.duplicated().to_numpy()]
+                self._maps.append(dict(zip(keys, keys.index)))
+        return self._maps
+
+    def _fold_batch(self, incoming):
+        # Union-find over rows that share any blocking key inside the batch
+        parent = np.arange(len(incoming))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for columns in self.config["match_keys"]:
+            keys = blocking_keys(incoming, columns)
+            keys = keys[(keys != "").to_numpy()]
+            first = pd.Series(keys.index, index=keys.index).groupby(keys.to_numpy()).transform("min")
+            for row, other in zip(first.index[first.index != first], first[first.index != first]):
+                parent[find(row)] = find(other)
+        roots = np.array([find(i) for i in range(len(incoming))], dtype=np.int64)
+        folded = incoming.loc[np.unique(roots)].copy()
+        # Later non-blank values win within a group
+        folded.update(incoming.where(incoming.astype(object).ne("")).groupby(roots).last())
+        return folded
+
+    def ingest(self, patients):
+        patients = patients.reindex(columns=PATIENT_COLUMNS).reset_index(drop=True)
+        report = {"incoming": len(patients), "merged": 0, "updated": 0, "skipped": 0, "inserted": 0}
+        if patients.empty:
+            return report
+        if not self.config.get("enabled", True):
+            self.store.append(patients)
+            report["inserted"] = len(patients)
+            return report
+        
+        with self._lock:
+            maps = self._existing_maps()
+            folded = self._fold_batch(patients)
+            report["merged"] = len(patients) - len(folded)
+            
+            rows = pd.Series(np.nan, index=folded.index)
+            for columns, mapping in zip(self.config["match_keys"], maps):
+                unmatched = rows.isna().to_numpy()
+                rows[unmatched] = blocking_keys(folded[unmatched], columns).map(mapping)
+            matched = rows.notna().to_numpy()
+            
+            if matched.any() and self.config["on_match"] == "update":
+                updates = folded[matched]
+                updates = updates.where(updates.astype(object).ne("")).groupby(rows[matched].astype(int).to_numpy()).last()
+                report["merged"] += int(matched.sum()) - len(updates)
+                current = self.store.load_rows(updates.index)
+                old_keys = [blocking_keys(current, columns) for columns in self.config["match_keys"]]
+                stored_ids = current["FHIR_Patient_ID"].map(normalize_fhir_id)
+                incoming_ids = updates.pop("FHIR_Patient_ID")
+                current = current.astype(object)
+                current.update(updates)
+                # A stored FHIR link is never replaced by a different incoming one
+                current["FHIR_Patient_ID"] = current["FHIR_Patient_ID"].where(stored_ids != "", incoming_ids)
+                self.store.update(current.index, current)
+                report["updated"] = len(current)
+                self._forget(old_keys)
+                self._remember(current)
+            elif matched.any():
+                report["skipped"] = int(matched.sum())
+            
+            new = folded[~matched]
+            if len(new):
+                positions = self.store.append(new)
+                report["inserted"] = len(new)
+                self._remember(new.set_axis(positions))
+            self._identity = self.store.identity()
+        return report
+
+    def _forget(self, old_keys):
+        for keys, mapping in zip(old_keys, self._maps):
+            for key, row in zip(keys, keys.index):
+                if key and mapping.get(key) == row:
+                    del mapping[key]
+
+    def _remember(self, rows):
+        for columns, mapping in zip(self.config["match_keys"], self._maps):
+            keys = blocking_keys(rows, columns)
+            for key, row in zip(keys, rows.index):
+                if key:
+                    mapping.setdefault(key, row)
+
+@st.cache_resource
+def get_deduplicator():
+    return PatientDeduplicator(get_store(), DEDUP_CONFIG)
+
+def ingest_patients(patients):
+    return get_deduplicator().ingest(patients)
 
 def save_data(df):
-    df.to_csv(DATA_FILE, index=False)
+    get_store().save(df)
+
+def append_patients(new_patients):
+    get_store().append(new_patients)
+
+def update_patients(positions, patients):
+    get_store().update(positions, patients)
+
+def upsert_by_fhir_id(patient):
+    return get_store().upsert_by_fhir_id(patient)
+
+def search_patient_names(query, prefix=False, fuzzy=False):
+    return get_store().search_names(query, prefix=prefix, fuzzy=fuzzy)
+
+def count_patients(filters=None, name_query="", fuzzy=False):
+    return get_store().count(filters, name_query, fuzzy)
+
+def find_patients_page(filters=None, name_query="", fuzzy=False, sort_by=None, ascending=True, offset=0, limit=50, total=None):
+    return get_store().find_page(filters, name_query, fuzzy, sort_by, ascending, offset, limit, total)
+
+class FHIRResponseCache:
+    # LRU of successful GET responses with a TTL. Expired entries keep their
+    # validators so the next request can be a conditional one (304 on no change).
+    # With a directory, entries are also written there as JSON and survive restarts.
+    def __init__(self, max_entries=1000, ttl=300, directory=""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0}
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            files = sorted(os.scandir(directory), key=lambda f: f.stat().st_mtime)
+            for f in files:
+                if f.name.endswith(".json"):
+                    self.entries[f.name[:-5]] = None
+
+    @staticmethod
+    def key(url, params=None):
+        query = urlencode(sorted((params or {}).items()))
+        return hashlib.sha256(f"{url}?{query}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            entry = self.entries[key]
+        if entry is None:
+            try:
+                with open(self._path(key)) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+            with self.lock:
+                if key in self.entries:
+                    self.entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        if self.directory:
+            with open(self._path(key), "w") as f:
+                json.dump(entry, f)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                if self.directory and os.path.exists(self._path(evicted)):
+                    os.remove(self._path(evicted))
+
+    def is_fresh(self, entry):
+        return time.time() - entry["stored"] < self.ttl
+
+    def record(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+def _response_validators(response):
+    # Prefer the server's headers, fall back to the resource's meta.versionId / lastUpdated
+    etag = response.headers.get("ETag", "")
+    last_modified = response.headers.get("Last-Modified", "")
+    if not etag or not last_modified:
+        try:
+            meta = response.json().get("meta", {})
+        except ValueError:
+            meta = {}
+        if not etag and meta.get("versionId"):
+            etag = f'W/"{meta["versionId"]}"'
+        if not last_modified and meta.get("lastUpdated"):
+            updated = pd.Timestamp(meta["lastUpdated"])
+            if updated.tzinfo is None:
+                updated = updated.tz_localize("UTC")
+            last_modified = format_datetime(updated.tz_convert("UTC").to_pydatetime(), usegmt=True)
+    return etag, last_modified
+
+def _retry_after(value):
+    # Retry-After is either delay-seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+def _cached_response(entry, url):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = "utf-8"
+    response._content = entry["body"].encode("utf-8")
+    return response
+
+def _fhir_operation(method, url, base_url):
+    # "GET Patient", "GET Patient/{id}", "GET Patient/$export", "POST [base]" -
+    # IDs are left out to keep the label set small, $operations are kept
+    path = url.split("?", 1)[0]
+    if path.startswith(base_url.rstrip("/")):
+        path = path[len(base_url.rstrip("/")):]
+    parts = [part for part in path.split("/") if part]
+    if not parts:
+        return f"{method} [base]"
+    return " ".join([method, "/".join(parts[:1] + [part if part.startswith("$") else "{id}" for part in parts[1:2]])])
 
 class FHIRClient:
     def __init__(self, config):
         self.config = config
+        self.timeout = config.get("timeout", (3.05, 30))
+        self.session = self._build_session()
+        self.cache = None
+        if config.get("cache_entries"):
+            self.cache = FHIRResponseCache(config["cache_entries"], config.get("cache_ttl", 300), config.get("cache_dir", ""))
+    
+    def _build_session(self):
+        retry = Retry(
+            total=self.config.get("max_retries", 3),
+            backoff_factor=self.config.get("backoff_factor", 0.5),
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},  # only read-only batch Bundles are POSTed
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        pool_size = self.config.get("pool_size", 10)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Accept": "application/fhir+json"})
+        return session
+    
+    def _request(self, method, url, **kwargs):
+        # Every outbound call goes through here so it is timed and sized
+        with metrics.span("fhir", _fhir_operation(method, url, self.config['base_url'])) as span:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            # Streamed bodies are read later by the caller, so only the declared size is known here
+            span["payload"] = int(response.headers.get("Content-Length") or 0) if kwargs.get("stream") else len(response.content)
+            span["error"] = response.status_code >= 400
+            return response
+    
+    def _get(self, url, params=None, revalidate=False):
+        # revalidate: always ask the server, conditionally when there is a cached copy
+        if self.cache is None:
+            return self._request("GET", url, params=params)
+        
+        key = self.cache.key(url, params)
+        entry = self.cache.get(key)
+        if entry and not revalidate and self.cache.is_fresh(entry):
+            self.cache.record("hits")
+            return _cached_response(entry, url)
+        
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        response = self._request("GET", url, params=params, headers=headers)
+        
+        if response.status_code == 304 and entry:
+            self.cache.record("revalidated")
+            entry["stored"] = time.time()
+            self.cache.put(key, entry)
+            return _cached_response(entry, url)
+        
+        self.cache.record("misses")
+        if response.status_code == 200:
+            etag, last_modified = _response_validators(response)
+            self.cache.put(key, {
+                "body": response.text,
+                "etag": etag,
+                "last_modified": last_modified,
+                "stored": time.time()
+            })
+        return response
     
     def search_patients(self, search_params=None):
         url = f"{self.config['base_url']}Patient"
         
         try:
-            response = requests.get(url, params=search_params)
+            response = self._get(url, params=search_params)
             return response.json() if response.status_code == 200 else None
         except Exception as e:
             st.error(f"Error searching patients: {str(e)}")
             return None
     
-    def get_patient_details(self, patient_id):
+    def iter_search(self, resource_type, search_params=None, count=None, elements=None, max_results=None, raise_errors=False, revalidate=False):
+        # Lazily follow the searchset Bundle's next links, one page in memory at a time
+        url = f"{self.config['base_url']}{resource_type}"
+        params = dict(search_params or {})
+        if count:
+            params['_count'] = count
+        if elements:
+            params['_elements'] = ','.join(elements)
+        yielded = 0
+        
+        while url:
+            try:
+                response = self._get(url, params=params, revalidate=revalidate)
+                if response.status_code != 200:
+                    if raise_errors:
+                        response.raise_for_status()
+                    return
+                bundle = json_loads(response.content)
+            except Exception as e:
+                if raise_errors:
+                    raise
+                st.error(f"Error searching {resource_type}: {str(e)}")
+                return
+            
+            for entry in bundle.get('entry', []):
+                if entry.get('search', {}).get('mode', 'match') != 'match':
+                    continue
+                yield entry['resource']
+                yielded += 1
+                if max_results and yielded >= max_results:
+                    return
+            
+            url = next((link['url'] for link in bundle.get('link', []) if link.get('relation') == 'next'), None)
+            params = None
+    
+    def iter_patients(self, search_params=None, count=None, elements=None, max_results=None, raise_errors=False, revalidate=False):
+        return self.iter_search('Patient', search_params, count=count, elements=elements,
+                                max_results=max_results, raise_errors=raise_errors, revalidate=revalidate)
+    
+    def chunk_ids(self, ids, chunk_size=100, max_url_length=2000):
+        # Split IDs into _id lists that stay under both the page size and the URL limit
+        budget = max_url_length - len(self.config['base_url']) - 200
+        chunk, length = [], 0
+        for fhir_id in ids:
+            cost = len(quote(str(fhir_id), safe='')) + 3
+            if chunk and (len(chunk) >= chunk_size or length + cost > budget):
+                yield chunk
+                chunk, length = [], 0
+            chunk.append(fhir_id)
+            length += cost
+        if chunk:
+            yield chunk
+    
+    def get_patients_by_ids(self, ids, chunk_size=100, max_url_length=2000, search_params=None, revalidate=False):
+        found = {}
+        for chunk in self.chunk_ids(ids, chunk_size, max_url_length):
+            params = dict(search_params or {})
+            params['_id'] = ','.join(map(str, chunk))
+            for resource in self.iter_patients(params, count=len(chunk), raise_errors=True, revalidate=revalidate):
+                found[resource.get('id', '')] = resource
+        return found
+    
+    def batch_get_patients(self, ids, chunk_size=100):
+        # One POSTed FHIR batch Bundle of Patient reads per chunk
+        found = {}
+        ids = list(ids)
+        for start in range(0, len(ids), chunk_size):
+            bundle = {
+                "resourceType": "Bundle",
+                "type": "batch",
+                "entry": [{"request": {"method": "GET", "url": f"Patient/{fhir_id}"}} for fhir_id in ids[start:start + chunk_size]]
+            }
+            response = self._request(
+                "POST",
+                self.config['base_url'],
+                data=json.dumps(bundle),
+                headers={"Content-Type": "application/fhir+json"}
+            )
+            response.raise_for_status()
+            for entry in response.json().get('entry', []):
+                resource = entry.get('resource')
+                if resource and entry.get('response', {}).get('status', '').startswith('200'):
+                    found[resource.get('id', '')] = resource
+        return found
+    
+    def get_patient_details(self, patient_id, revalidate=False):
         url = f"{self.config['base_url']}Patient/{patient_id}"
         
         try:
-            response = requests.get(url)
+            response = self._get(url, revalidate=revalidate)
             return response.json() if response.status_code == 200 else None
         except Exception as e:
             st.error(f"Error getting patient details: {str(e)}")
             return None
     
     def get_patient_observations(self, patient_id):
-        url = f"{self.config['base_url']}Observation"
-        params = {'patient': patient_id}
-        
+        return list(self.iter_observations([patient_id]))
+    
+    def iter_observations(self, patient_ids, codes=None, count=200, max_results=None, raise_errors=False):
+        # Observations for many patients, one patient=a,b,... search per ID chunk
+        params = {}
+        if codes:
+            params['code'] = ','.join(f"http://loinc.org|{code}" for code in codes)
+        remaining = max_results
+        for chunk in self.chunk_ids(patient_ids, self.config.get('batch_size', 100), self.config.get('max_url_length', 2000)):
+            params['patient'] = ','.join(map(str, chunk))
+            for resource in self.iter_search('Observation', params, count=count, max_results=remaining, raise_errors=raise_errors):
+                yield resource
+                if remaining:
+                    remaining -= 1
+                    if not remaining:
+                        return
+    
+    def start_export(self, resource_types=None, since=None):
+        # Kick off an asynchronous Bulk Data export of the Patient compartment; returns the status URL
+        params = {"_outputFormat": "application/fhir+ndjson"}
+        if resource_types:
+            params["_type"] = ",".join(resource_types)
+        if since:
+            params["_since"] = since
+        response = self._request("GET", f"{self.config['base_url']}Patient/$export", params=params,
+                                 headers={"Prefer": "respond-async"})
+        response.raise_for_status()
+        if response.status_code != 202 or not response.headers.get("Content-Location"):
+            raise ValueError(f"Server did not start an asynchronous export (HTTP {response.status_code})")
+        return response.headers["Content-Location"]
+    
+    def export_status(self, status_url):
+        # (manifest, None, "") when the export is complete, else (None, Retry-After seconds, X-Progress)
+        response = self._request("GET", status_url)
+        if response.status_code == 202:
+            return None, _retry_after(response.headers.get("Retry-After")), response.headers.get("X-Progress", "")
+        response.raise_for_status()
+        return json_loads(response.content), None, ""
+    
+    def wait_for_export(self, status_url, poll_interval=5.0, max_wait=3600, progress=None):
+        deadline = time.time() + max_wait
+        while True:
+            manifest, retry_after, status = self.export_status(status_url)
+            if manifest is not None:
+                return manifest
+            delay = poll_interval if retry_after is None else retry_after
+            if time.time() + delay > deadline:
+                raise TimeoutError(f"Bulk export not finished after {max_wait} seconds")
+            if progress:
+                progress(status)
+            time.sleep(delay)
+    
+    def cancel_export(self, status_url):
+        # Lets the server delete the job and its files; failures are harmless
         try:
-            response = requests.get(url, params=params)
-            return response.json() if response.status_code == 200 else None
-        except Exception as e:
-            st.error(f"Error getting observations: {str(e)}")
-            return None
+            self._request("DELETE", status_url)
+        except requests.RequestException:
+            pass
+    
+    def iter_ndjson(self, url, skip=0):
+        # Stream an export output file line by line (blank lines included, so
+        # positions stay stable for resuming), skipping the first `skip` lines
+        with self._request("GET", url, stream=True, headers={"Accept": "application/fhir+ndjson"}) as response:
+            response.raise_for_status()
+            for position, line in enumerate(response.iter_lines(chunk_size=64 * 1024)):
+                if position >= skip:
+                    yield line
+
+def parse_fhir_patients(source, now=None):
+    # Batch parser: a searchset/batch Bundle or any iterable of Patient resources
+    # becomes one DataFrame; only the JSON walk is per resource, everything else
+    # is columnar, and the whole batch shares one reference time.
+    if isinstance(source, dict):
+        source = (entry.get('resource') for entry in source.get('entry', []))
+    ids, given, family, birth_dates, genders, phones = [], [], [], [], [], []
+    for resource in source:
+        if not resource or resource.get('resourceType', 'Patient') != 'Patient':
+            continue
+        names = resource.get('name')
+        name = names[0] if names else {}
+        ids.append(resource.get('id', ''))
+        given.append(' '.join(name.get('given') or ()))
+        family.append(name.get('family') or '')
+        birth_dates.append(resource.get('birthDate'))
+        genders.append(resource.get('gender') or '')
+        phones.append(next((t.get('value', '') for t in resource.get('telecom') or () if t.get('system') == 'phone'), ''))
+    
+    now = now or datetime.now()
+    birth_dates = pd.to_datetime(pd.Series(birth_dates, dtype=object), format='ISO8601', errors='coerce')
+    return pd.DataFrame({
+        'Name': (pd.Series(given, dtype=str) + ' ' + pd.Series(family, dtype=str)).str.strip(),
+        'Age': (now.year - birth_dates.dt.year).astype('Int64'),
+        'Gender': pd.Series(genders, dtype=str).str.capitalize(),
+        'Contact': pd.Series(phones, dtype=str),
+        'Blood Type': '',
+        'Allergies': '',
+        'Medical History': '',
+        'FHIR_Patient_ID': pd.Series(ids, dtype=str),
+        'Last_Sync': now.strftime('%Y-%m-%d %H:%M:%S'),
+        'Source': 'FHIR Server'
+    })
+
+def parse_fhir_ndjson(lines, now=None):
+    # NDJSON (bulk export) lines as str or bytes, e.g. an open file
+    return parse_fhir_patients((json_loads(line) for line in lines if line.strip()), now=now)
+
+def _patient_records(parsed):
+    # Row dicts with "" for missing values, as the single-patient parser returns
+    records = parsed.to_dict('records')
+    for record in records:
+        for key, value in record.items():
+            if pd.isna(value):
+                record[key] = ''
+    return records
 
 def parse_fhir_patient_data(fhir_patient):
     try:
-        name = ""
-        if 'name' in fhir_patient and fhir_patient['name']:
-            name_obj = fhir_patient['name'][0]
-            given = name_obj.get('given', [])
-            family = name_obj.get('family', '')
-            name = f"{' '.join(given)} {family}".strip()
-        
-        age = ""
-        if 'birthDate' in fhir_patient:
-            birth_date = datetime.strptime(fhir_patient['birthDate'], '%Y-%m-%d')
-            age = datetime.now().year - birth_date.year
-        
-        gender = fhir_patient.get('gender', '').capitalize()
-        contact = ""
-        
-        if 'telecom' in fhir_patient:
-            for telecom in fhir_patient['telecom']:
-                if telecom.get('system') == 'phone':
-                    contact = telecom.get('value', '')
-                    break
-        
-        return {
-            'Name': name,
-            'Age': age,
-            'Gender': gender,
-            'Contact': contact,
-            'Blood Type': '',
-            'Allergies': '',
-            'Medical History': '',
-            'FHIR_Patient_ID': fhir_patient.get('id', ''),
-            'Last_Sync': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'Source': 'FHIR Server'
-        }
+        return _patient_records(parse_fhir_patients([fhir_patient]))[0]
     except Exception as e:
         st.error(f"Error parsing FHIR patient data: {str(e)}")
         return None
 
-# Initialize FHIR client
-fhir_client = FHIRClient(FHIR_CONFIG)
+def merge_synced_patient(patient, updated_data):
+    synced = dict(patient)
+    for key, value in updated_data.items():
+        if key != 'FHIR_Patient_ID':
+            synced[key] = value
+    return synced
+
+def merge_synced_patients(current, parsed):
+    # Frame version of merge_synced_patient: parsed rows overwrite the stored
+    # rows with the same FHIR ID, keeping the stored row positions and IDs
+    updates = parsed.drop_duplicates('FHIR_Patient_ID', keep='last').set_index('FHIR_Patient_ID')
+    ids = current['FHIR_Patient_ID'].map(normalize_fhir_id)
+    current = current[ids.isin(updates.index).to_numpy()]
+    columns = [column for column in updates.columns if column in current.columns]
+    merged = current.astype(object)
+    merged[columns] = updates.loc[ids[current.index].to_numpy(), columns].astype(object).to_numpy()
+    return merged
+
+# LOINC codes of the vital signs summarized on the Observations page
+VITAL_CODES = {
+    "8867-4": "Heart rate",
+    "8480-6": "Systolic BP",
+    "8462-4": "Diastolic BP",
+    "8310-5": "Body temperature",
+    "9279-1": "Respiratory rate",
+    "59408-5": "Oxygen saturation",
+    "29463-7": "Body weight",
+    "8302-2": "Body height",
+    "39156-5": "BMI"
+}
+OBSERVATION_COLUMNS = ["obs_id", "patient_id", "code", "value", "unit", "effective"]
+
+def _observation_code(code):
+    codings = (code or {}).get('coding') or [{}]
+    loinc = next((coding for coding in codings if coding.get('system') == 'http://loinc.org'), codings[0])
+    return loinc.get('code', '')
+
+def flatten_observations(resources):
+    # One row per numeric value; panels such as blood pressure give a row per component
+    columns = {column: [] for column in OBSERVATION_COLUMNS}
+    for resource in resources:
+        subject = (resource.get('subject') or {}).get('reference', '')
+        patient_id = subject.rsplit('/', 1)[-1]
+        effective = resource.get('effectiveDateTime') or (resource.get('effectivePeriod') or {}).get('start') or resource.get('issued')
+        parts = [resource] + resource.get('component', [])
+        for part in parts:
+            quantity = part.get('valueQuantity')
+            if not quantity or quantity.get('value') is None:
+                continue
+            columns['obs_id'].append(resource.get('id', ''))
+            columns['patient_id'].append(patient_id)
+            columns['code'].append(_observation_code(part.get('code')))
+            columns['value'].append(quantity['value'])
+            columns['unit'].append(quantity.get('unit') or quantity.get('code') or '')
+            columns['effective'].append(effective)
+    return _typed_observations(pd.DataFrame(columns))
+
+def _typed_observations(df):
+    df = df.reindex(columns=OBSERVATION_COLUMNS)
+    return df.assign(
+        obs_id=df['obs_id'].astype(str),
+        patient_id=df['patient_id'].astype(str).astype('category'),
+        code=df['code'].astype(str).astype('category'),
+        value=pd.to_numeric(df['value'], errors='coerce'),
+        unit=df['unit'].fillna('').astype(str).astype('category'),
+        effective=pd.to_datetime(df['effective'], utc=True, errors='coerce', format='ISO8601')
+    )
+
+class ObservationStore:
+    # Flattened observations in one columnar file plus a part file per added
+    # batch, re-read only when they change. A re-fetched observation replaces
+    # the stored one: duplicates are dropped on read, and compaction folds the
+    # parts back into the main file.
+    MAX_PARTS = 64
+
+    def __init__(self, path):
+        self.path = path if pa is not None else os.path.splitext(path)[0] + ".csv"
+        self.parts_dir = os.path.splitext(self.path)[0] + "_parts"
+        self.extension = os.path.splitext(self.path)[1]
+        self._lock = threading.Lock()
+        self._cached = (None, None)
+        self._keys = (None, None)
+
+    def _parts(self):
+        if not os.path.isdir(self.parts_dir):
+            return []
+        return sorted(os.path.join(self.parts_dir, name) for name in os.listdir(self.parts_dir)
+                      if name.startswith("part-") and name.endswith(self.extension))
+
+    def _identity(self):
+        return tuple(map(_file_identity, [self.path] + self._parts()))
+
+    def _read_file(self, path):
+        if pa is not None:
+            return pd.read_parquet(path)
+        return pd.read_csv(path, dtype={"obs_id": str, "patient_id": str, "code": str})
+
+    def _write_file(self, df, path):
+        tmp_path = f"{path}.tmp"
+        if pa is not None:
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def _load(self):
+        identity = self._identity()
+        if self._cached[0] != identity:
+            paths = [path for path in [self.path] + self._parts() if os.path.exists(path)]
+            frames = [self._read_file(path) for path in paths]
+            if not frames:
+                df = pd.DataFrame(columns=OBSERVATION_COLUMNS)
+            elif len(frames) == 1:
+                df = frames[0]
+            else:
+                df = pd.concat(frames, ignore_index=True).drop_duplicates(["obs_id", "code"], keep="last")
+            self._cached = (identity, _typed_observations(df.reset_index(drop=True)))
+        return self._cached[1]
+
+    def load(self):
+        with self._lock:
+            return self._load()
+
+    def _compact(self):
+        self._write_file(self._load(), self.path)
+        for part in self._parts():
+            os.remove(part)
+        self._cached = (self._identity(), self._cached[1])
+
+    def add(self, observations):
+        # Writes only the new batch; returns how many observations were not stored before
+        observations = _typed_observations(observations.drop_duplicates(["obs_id", "code"], keep="last"))
+        with self._lock:
+            identity = self._identity()
+            if self._keys[0] != identity:
+                stored = self._load()
+                self._keys = (identity, set(zip(stored["obs_id"], stored["code"])))
+            keys = self._keys[1]
+            batch = set(zip(observations["obs_id"], observations["code"]))
+            added = len(batch - keys)
+            keys |= batch
+            if len(observations):
+                os.makedirs(self.parts_dir, exist_ok=True)
+                self._write_file(observations, os.path.join(self.parts_dir, f"part-{time.time_ns():020d}{self.extension}"))
+                if len(self._parts()) > self.MAX_PARTS:
+                    self._compact()
+            self._keys = (self._identity(), keys)
+        return added
+
+def sync_observations(client, patient_ids, codes=None, page_size=200):
+    # Observations are flattened page by page, then written to the table once
+    frames, batch = [], []
+    for resource in client.iter_observations(patient_ids, codes=codes, count=page_size, raise_errors=True):
+        batch.append(resource)
+        if len(batch) >= page_size:
+            frames.append(flatten_observations(batch))
+            batch = []
+    frames.append(flatten_observations(batch))
+    new = _typed_observations(pd.concat(frames, ignore_index=True))
+    added = get_observation_store().add(new)
+    return {"fetched": len(new), "added": added}
+
+def vitals_summary(observations, codes=None):
+    # Latest value, range, mean and a least-squares trend per patient and code, in one groupby
+    obs = observations.dropna(subset=["value", "effective"])
+    if codes:
+        obs = obs[obs["code"].isin(codes)]
+    obs = obs.sort_values(["patient_id", "code", "effective"], kind="stable")
+    days = (obs["effective"] - obs["effective"].min()) / pd.Timedelta(days=1)
+    obs = obs.assign(x=days, xy=days * obs["value"], xx=days * days)
+    summary = obs.groupby(["patient_id", "code"], observed=True, sort=False).agg(
+        count=("value", "size"),
+        latest=("value", "last"),
+        latest_at=("effective", "last"),
+        min=("value", "min"),
+        max=("value", "max"),
+        mean=("value", "mean"),
+        unit=("unit", "last"),
+        x_min=("x", "min"),
+        x_max=("x", "max"),
+        sx=("x", "sum"),
+        sy=("value", "sum"),
+        sxy=("xy", "sum"),
+        sxx=("xx", "sum")
+    )
+    n = summary["count"]
+    slope = (n * summary["sxy"] - summary["sx"] * summary["sy"]) / (n * summary["sxx"] - summary["sx"] ** 2)
+    summary["trend_per_day"] = slope.where(summary["x_max"] > summary["x_min"])
+    summary = summary.drop(columns=["x_min", "x_max", "sx", "sy", "sxy", "sxx"]).reset_index()
+    summary.insert(2, "vital", summary["code"].astype(str).map(VITAL_CODES).fillna(summary["code"].astype(str)))
+    return summary
+
+class RateLimiter:
+    # Spaces out calls from many threads to at most `rate` per second
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+def sync_all_patients(client, max_workers=8, rate_limit=20, batch_size=100):
+    # Fetch every FHIR-linked patient in _id batches on a worker pool, then
+    # apply all the updates to the store in a single write.
+    started = time.monotonic()
+    linked_rows = get_store().fhir_linked_rows()
+    limiter = RateLimiter(rate_limit)
+    fetched, failed = {}, {}
+
+    def fetch(chunk):
+        limiter.wait()
+        return client.get_patients_by_ids(chunk, chunk_size=len(chunk), max_url_length=client.config.get("max_url_length", 2000),
+                                          revalidate=True)
+
+    chunks = client.chunk_ids(list(linked_rows), batch_size, client.config.get("max_url_length", 2000))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                resources = future.result()
+            except Exception as e:
+                failed.update({fhir_id: str(e) for fhir_id in chunk})
+                continue
+            for fhir_id in chunk:
+                if fhir_id in resources:
+                    fetched[fhir_id] = resources[fhir_id]
+                else:
+                    failed[fhir_id] = "Not found on server"
+
+    current = load_rows(linked_rows[fhir_id] for fhir_id in fetched)
+    synced = merge_synced_patients(current, parse_fhir_patients(fetched.values()))
+    if len(synced):
+        update_patients(synced.index, synced)
+
+    elapsed = time.monotonic() - started
+    return {
+        "requested": len(linked_rows),
+        "synced": len(synced),
+        "failed": failed,
+        "seconds": elapsed,
+        "per_second": len(linked_rows) / elapsed if elapsed else 0.0
+    }
+
+def sync_changed_patients(client, chunk_size=100, clock_skew=60):
+    # Only ask the server for linked patients changed since the last successful
+    # incremental sync; the watermark lives in the store's meta record.
+    started = datetime.now(timezone.utc) - timedelta(seconds=clock_skew)
+    store = get_store()
+    watermark = store.get_meta("sync_watermark")
+    linked_rows = store.fhir_linked_rows()
+    fhir_ids = list(linked_rows)
+    changed = client.get_patients_by_ids(
+        fhir_ids,
+        chunk_size=chunk_size,
+        max_url_length=client.config.get("max_url_length", 2000),
+        search_params={'_lastUpdated': f"gt{watermark}"} if watermark else None,
+        revalidate=True
+    )
+
+    changed = {fhir_id: resource for fhir_id, resource in changed.items() if fhir_id in linked_rows}
+    current = load_rows(linked_rows[fhir_id] for fhir_id in changed)
+    synced = merge_synced_patients(current, parse_fhir_patients(changed.values()))
+    if len(synced):
+        update_patients(synced.index, synced)
+
+    new_watermark = started.strftime('%Y-%m-%dT%H:%M:%SZ')
+    store.set_meta("sync_watermark", new_watermark)
+    return {"checked": len(fhir_ids), "changed": len(synced), "since": watermark, "watermark": new_watermark}
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def _load_bulk_batch(resource_type, lines, report):
+    if resource_type == "Patient":
+        result = ingest_patients(parse_fhir_ndjson(lines))
+        for key in ("inserted", "updated", "merged"):
+            report[key] += result[key]
+    else:
+        observations = flatten_observations(json_loads(line) for line in lines if line.strip())
+        report["observations_added"] += get_observation_store().add(observations)
+    report[resource_type] += sum(1 for line in lines if line.strip())
+
+def bulk_import(client, config, since=None, progress=None):
+    # Initial load or refresh from a FHIR Bulk Data export. Output files are
+    # streamed through the batch parsers and written config["batch_rows"] lines
+    # at a time, and the checkpoint file records the job and how far each file
+    # got after every batch. A rerun after a failure resumes the same job where
+    # it stopped; a batch replayed after a crash only re-updates the same rows,
+    # since patients are deduplicated and observations keyed by ID.
+    path = config["checkpoint_file"]
+    checkpoint = _read_checkpoint(path)
+    if checkpoint is None:
+        checkpoint = {
+            "status_url": client.start_export(config["resource_types"], since),
+            "since": since,
+            "started": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "manifest": None,
+            "files": {}
+        }
+        _write_checkpoint(path, checkpoint)
+    
+    if checkpoint["manifest"] is None:
+        checkpoint["manifest"] = client.wait_for_export(
+            checkpoint["status_url"], config["poll_interval"], config["max_wait"],
+            progress=(lambda status: progress("waiting", status)) if progress else None
+        )
+        _write_checkpoint(path, checkpoint)
+    
+    report = defaultdict(int, resumed=sum(checkpoint["files"].values()))
+    # Patients first, so observations arrive for patients that are already stored
+    outputs = [output for output in checkpoint["manifest"].get("output", []) if output.get("type") in ("Patient", "Observation")]
+    outputs.sort(key=lambda output: output["type"] != "Patient")
+    for output in outputs:
+        url = output["url"]
+        if url in checkpoint.get("completed", []):
+            continue
+        position = checkpoint["files"].get(url, 0)
+        lines = []
+        for line in client.iter_ndjson(url, skip=position):
+            lines.append(line)
+            if len(lines) >= config["batch_rows"]:
+                _load_bulk_batch(output["type"], lines, report)
+                position += len(lines)
+                checkpoint["files"][url] = position
+                _write_checkpoint(path, checkpoint)
+                lines = []
+                if progress:
+                    progress(output["type"], report[output["type"]])
+        if lines:
+            _load_bulk_batch(output["type"], lines, report)
+        checkpoint["files"][url] = position + len(lines)
+        checkpoint.setdefault("completed", []).append(url)
+        _write_checkpoint(path, checkpoint)
+    
+    # The next refresh only asks for resources changed since this export
+    transaction_time = checkpoint["manifest"].get("transactionTime")
+    if transaction_time:
+        get_store().set_meta("bulk_export_since", transaction_time)
+    client.cancel_export(checkpoint["status_url"])
+    os.remove(path)
+    return dict(report, files=len(outputs), since=checkpoint["since"], transaction_time=transaction_time)
+
+GENDERS = ["Male", "Female", "Other"]
+BLOOD_TYPES = ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-", "Unknown"]
+
+def validate_api_patient(payload):
+    # Maps a hospital API payload onto a patient row, raising ValueError if it is unusable
+    if not isinstance(payload, dict):
+        raise ValueError("patient must be a JSON object")
+    name = payload.get("name")
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("name is required")
+    age = payload.get("age")
+    if age is not None and (isinstance(age, bool) or not isinstance(age, int) or not 0 <= age <= 150):
+        raise ValueError("age must be an integer between 0 and 150")
+    gender = payload.get("gender")
+    if gender is not None and gender not in GENDERS:
+        raise ValueError(f"gender must be one of {', '.join(GENDERS)}")
+    blood_type = payload.get("blood_type")
+    if blood_type is not None and blood_type not in BLOOD_TYPES:
+        raise ValueError(f"blood_type must be one of {', '.join(BLOOD_TYPES)}")
+    return {
+        "Name": name.strip(),
+        "Age": age,
+        "Gender": gender,
+        "Contact": str(payload.get("contact") or ""),
+        "Blood Type": blood_type,
+        "Allergies": str(payload.get("allergies") or ""),
+        "Medical History": str(payload.get("medical_history") or ""),
+        "FHIR_Patient_ID": normalize_fhir_id(payload.get("patient_id")),
+        "Last_Sync": str(payload.get("timestamp") or datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        "Source": "Hospital Integration"
+    }
+
+class IngestServer:
+    # Minimal asyncio HTTP/1.1 server for hospital pushes, run on its own thread.
+    # POSTs are validated and queued, then answered 202 straight away; a single
+    # flusher writes the queue to the store whenever batch_size patients are
+    # waiting or flush_interval has passed, so a burst of requests turns into a
+    # few store writes. Queued patients are lost if the process dies before a flush.
+    STATUS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found",
+              405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+    def __init__(self, write, config):
+        self.write = write  # DataFrame of patients -> report dict
+        self.config = config
+        self.url = f"http://{config['host']}:{config['port']}"
+        self.error = None
+        self.stats = {"requests": 0, "received": 0, "rejected": 0, "batches": 0, "written": 0,
+                      "inserted": 0, "updated": 0, "merged": 0, "last_batch": 0, "last_flush": None, "write_errors": 0}
+        self._pending = []
+        self._writing = 0
+        self._ready = threading.Event()
 
-# Streamlit App
-st.set_page_config(page_title="Patient Health Records", layout="wide")
-st.title("🏥 Patient Health Records - FHIR Integration with Demo")
+    def start(self):
+        threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True, name="ingest-server").start()
+        self._ready.wait(10)
+        return self
+
+    def queue_depth(self):
+        return len(self._pending) + self._writing
+
+    async def _serve(self):
+        self._wakeup = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self._handle, self.config["host"], self.config["port"])
+        except OSError as e:
+            self.error = f"Could not listen on {self.url}: {e}"
+            self._ready.set()
+            return
+        self._ready.set()
+        print(f"✅ Ingestion endpoint listening on {self.url}/api/patients")
+        async with server:
+            await self._flush_loop()
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.config["flush_interval"])
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._pending:
+                batch, self._pending = self._pending[:self.config["batch_size"]], self._pending[self.config["batch_size"]:]
+                self._writing = len(batch)
+                try:
+                    report = await loop.run_in_executor(None, self.write, pd.DataFrame(batch))
+                except Exception as e:
+                    # Keep the batch queued and retry on the next tick
+                    self._pending[:0] = batch
+                    self.stats["write_errors"] += 1
+                    print(f"Ingestion write failed: {e}")
+                    break
+                finally:
+                    self._writing = 0
+                self.stats["batches"] += 1
+                self.stats["written"] += len(batch)
+                for key in ("inserted", "updated", "merged"):
+                    self.stats[key] += report.get(key, 0)
+                self.stats["last_batch"] = len(batch)
+                self.stats["last_flush"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > self.config["max_body_mb"] * 1024 * 1024:
+                    await self._respond(writer, 413, {"status": "error", "message": "Request body too large"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, payload = self._route(method, target.split("?", 1)[0], body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        # Text payloads are the Prometheus export, everything else is JSON
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        head = (f"HTTP/1.1 {status} {self.STATUS[status]}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    def _route(self, method, path, body):
+        if path == "/api/health":
+            return 200, dict(self.stats, queued=self.queue_depth())
+        if path == "/metrics":
+            return 200, metrics.prometheus()
+        if path != "/api/patients":
+            return 404, {"status": "error", "message": "Not found"}
+        if method != "POST":
+            return 405, {"status": "error", "message": "Use POST"}
+        self.stats["requests"] += 1
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.stats["rejected"] += 1
+            return 400, {"status": "error", "message": "Body is not valid JSON"}
+        # A single patient object, a list of them, or {"patients": [...]}
+        if isinstance(payload, dict) and isinstance(payload.get("patients"), list):
+            payload = payload["patients"]
+        items = payload if isinstance(payload, list) else [payload]
+        rows, errors = [], []
+        for i, item in enumerate(items):
+            try:
+                rows.append(validate_api_patient(item))
+            except ValueError as e:
+                errors.append({"index": i, "message": str(e)})
+        if errors or not rows:
+            self.stats["rejected"] += len(items)
+            return 400, {"status": "error", "message": "Validation failed", "errors": errors or [{"index": 0, "message": "no patients"}]}
+        if self.queue_depth() + len(rows) > self.config["max_queue"]:
+            self.stats["rejected"] += len(rows)
+            return 503, {"status": "error", "message": "Ingestion queue is full, retry later"}
+        self._pending.extend(rows)
+        self.stats["received"] += len(rows)
+        if len(self._pending) >= self.config["batch_size"]:
+            self._wakeup.set()
+        return 202, {"status": "accepted", "accepted": len(rows), "queued": self.queue_depth()}
+
+class WebhookQueue:
+    # Hospital webhook events are appended (and fsynced) to a JSONL log before
+    # they are acknowledged, then coalesced per patient_id in memory. Once a
+    # patient has been quiet for the debounce window only its latest event is
+    # applied: patients whose event carries no data are fetched in bulk, and the
+    # whole batch goes to the store in one upsert_many. A checkpoint line in the
+    # log marks every event before it as applied, so a restart replays the rest.
+    # Once the log has grown past twice log_keep, it is rewritten with just the
+    # checkpoint, the unapplied events and the last log_keep applied ones.
+    EVENTS = ("patient_created", "patient_updated")
+
+    def __init__(self, store, config, fetch=None):
+        self.store = store
+        self.config = config
+        self.fetch = fetch  # ids -> {id: parsed patient} for events without inline data
+        self.log_file = config["event_log"]
+        self.stats = {"received": 0, "coalesced": 0, "applied": 0, "batches": 0, "not_found": 0,
+                      "failed": 0, "last_batch": None, "last_error": None}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._process_lock = threading.Lock()
+        self._seq, self.checkpoint, self._log_lines = 0, 0, 0
+        for record in self._read_log():
+            # A compacted log may hold no events up to the checkpoint, so it bounds the sequence too
+            self._seq = max(self._seq, record.get("seq", 0), record.get("checkpoint", 0))
+            self.checkpoint = max(self.checkpoint, record.get("checkpoint", 0))
+            self._log_lines += 1
+        self.replay()
+
+    def start(self):
+        def run():
+            while True:
+                time.sleep(self.config["poll_interval"])
+                self.process()
+        threading.Thread(target=run, daemon=True, name="webhook-queue").start()
+        return self
+
+    def _read_log(self):
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # torn write at the end of the log
+
+    def _append_log(self, record):
+        with open(self.log_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_lines += 1
+
+    def _compact_log(self):
+        # Called with _lock held, so no event is appended while the log is replaced
+        applied, pending = deque(maxlen=self.config["log_keep"]), []
+        for record in self._read_log():
+            if "seq" in record:
+                (applied if record["seq"] <= self.checkpoint else pending).append(record)
+        records = [{"checkpoint": self.checkpoint, "time": time.time()}] + list(applied) + pending
+        tmp_path = f"{self.log_file}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.log_file)
+        self._log_lines = len(records)
+
+    def _enqueue(self, record):
+        patient_id = normalize_fhir_id(record["event"].get("patient_id"))
+        if patient_id in self._pending:
+            self.stats["coalesced"] += 1
+        else:
+            self._pending[patient_id] = {"first_seq": record["seq"], "first_received": record["received"]}
+        self._pending[patient_id].update(last_seq=record["seq"], last_received=record["received"], event=record["event"])
+
+    def submit(self, event):
+        if not isinstance(event, dict) or event.get("event") not in self.EVENTS:
+            raise ValueError(f"event must be one of {', '.join(self.EVENTS)}")
+        if not normalize_fhir_id(event.get("patient_id")):
+            raise ValueError("patient_id is required")
+        if event.get("patient") is not None:
+            validate_api_patient(event["patient"])
+        with self._lock:
+            self._seq += 1
+            record = {"seq": self._seq, "received": time.time(), "event": event}
+            self._append_log(record)
+            self._enqueue(record)
+            self.stats["received"] += 1
+            return self._seq
+
+    def replay(self, from_checkpoint=True):
+        # Re-queue logged events; applying them again is harmless since they are upserts
+        start = self.checkpoint if from_checkpoint else 0
+        count = 0
+        with self._lock:
+            for record in self._read_log():
+                if record.get("seq", 0) > start:
+                    self._enqueue(record)
+                    count += 1
+        return count
+
+    def depth(self):
+        return len(self._pending)
+
+    def lag(self):
+        with self._lock:
+            oldest = min((entry["first_received"] for entry in self._pending.values()), default=None)
+        return 0.0 if oldest is None else time.time() - oldest
+
+    def process(self, force=False):
+        with self._process_lock:
+            now = time.time()
+            with self._lock:
+                due = {
+                    patient_id: dict(entry) for patient_id, entry in self._pending.items()
+                    if force or now - entry["last_received"] >= self.config["debounce"]
+                }
+                due = dict(list(due.items())[:self.config["max_batch"]])
+            if not due:
+                return None
+            try:
+                patients = self._resolve(due)
+                result = self.store.upsert_many(pd.DataFrame(patients, columns=PATIENT_COLUMNS))
+            except Exception as e:
+                self.stats["failed"] += 1
+                self.stats["last_error"] = str(e)
+                print(f"Webhook batch failed: {e}")
+                return None
+            with self._lock:
+                for patient_id, entry in due.items():
+                    # Events that arrived while we were writing stay queued
+                    if self._pending.get(patient_id, {}).get("last_seq") == entry["last_seq"]:
+                        del self._pending[patient_id]
+                checkpoint = min((entry["first_seq"] for entry in self._pending.values()), default=self._seq + 1) - 1
+                if checkpoint > self.checkpoint:
+                    self.checkpoint = checkpoint
+                    self._append_log({"checkpoint": checkpoint, "time": time.time()})
+                    if self._log_lines > 2 * self.config["log_keep"]:
+                        self._compact_log()
+            result["events"] = len(due)
+            self.stats["applied"] += len(patients)
+            self.stats["batches"] += 1
+            self.stats["last_batch"] = result
+            return result
+
+    def _resolve(self, due):
+        patients, missing = [], []
+        for patient_id, entry in due.items():
+            if entry["event"].get("patient") is not None:
+                patient = validate_api_patient(entry["event"]["patient"])
+                patient["FHIR_Patient_ID"] = patient_id
+                patients.append(patient)
+            else:
+                missing.append(patient_id)
+        if missing and self.fetch:
+            fetched = {normalize_fhir_id(k): v for k, v in self.fetch(missing).items() if v}
+            rows = {patient_id: self.store.find_by_fhir_id(patient_id) for patient_id in fetched}
+            current = self.store.load_rows([row for row in rows.values() if row is not None])
+            for patient_id, updated_data in fetched.items():
+                row = rows[patient_id]
+                base = current.loc[row].to_dict() if row is not None else {"Source": "Hospital Integration"}
+                patients.append(dict(merge_synced_patient(base, updated_data), FHIR_Patient_ID=patient_id))
+            self.stats["not_found"] += len(missing) - len(fetched)
+        elif missing:
+            self.stats["not_found"] += len(missing)
+        return patients
+
+    def recent_events(self, limit=20):
+        events = [record for record in self._read_log() if "seq" in record][-limit:]
+        return [{
+            "seq": record["seq"],
+            "timestamp": datetime.fromtimestamp(record["received"]).strftime('%Y-%m-%d %H:%M:%S'),
+            "event": record["event"].get("event"),
+            "patient_id": record["event"].get("patient_id"),
+            "status": "applied" if record["seq"] <= self.checkpoint else "pending"
+        } for record in reversed(events)]
+
+# Patient fields used by parse_fhir_patient_data, for _elements-trimmed searches
+PATIENT_ELEMENTS = ["name", "birthDate", "gender", "telecom"]
+
+# Initialize FHIR client (kept across reruns so its connection pool is reused)
+@st.cache_resource
+def get_fhir_client():
+    return FHIRClient(FHIR_CONFIG)
+
+fhir_client = get_fhir_client()
+
+# The ingestion endpoint is started once per process, on first use
+@st.cache_resource
+def get_ingest_server():
+    return IngestServer(ingest_patients, INGEST_CONFIG).start()
+
+def fetch_fhir_patients(ids):
+    # Webhook notifications mean the server copy just changed, so never trust a fresh cache entry
+    found = fhir_client.get_patients_by_ids(ids, FHIR_CONFIG['batch_size'], FHIR_CONFIG['max_url_length'], revalidate=True)
+    parsed = parse_fhir_patients(found.values())
+    return dict(zip(parsed['FHIR_Patient_ID'], _patient_records(parsed)))
+
+@st.cache_resource
+def get_observation_store():
+    return ObservationStore(STORAGE_CONFIG["observations_file"])
+
+@st.cache_resource
+def get_webhook_queue():
+    return WebhookQueue(get_store(), WEBHOOK_CONFIG, fetch=fetch_fhir_patients).start()
 
 # Configuration section
 def show_configuration():
@@ -172,6 +2757,12 @@ def show_configuration():
         """)
         
         st.info("This demo uses a public test FHIR server at https://hapi.fhir.org/")
+        
+        if fhir_client.cache is not None:
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Cache Hits", fhir_client.cache.stats["hits"])
+            col2.metric("Revalidated (304)", fhir_client.cache.stats["revalidated"])
+            col3.metric("Cache Misses", fhir_client.cache.stats["misses"])
 
 # Patient Management
 def add_patient():
@@ -190,7 +2781,6 @@ def add_patient():
             if not name or not age or not gender or not contact:
                 st.error("Please fill required fields (*)!")
             else:
-                df = load_data()
                 new_patient = pd.DataFrame([{
                     "Name": name, "Age": age, "Gender": gender,
                     "Contact": contact, "Blood Type": blood_type,
@@ -199,101 +2789,206 @@ def add_patient():
                     "Last_Sync": datetime.now().strftime('%Y-%m-%d %H:%M:%S') if fhir_patient_id else "",
                     "Source": "Manual Entry"
                 }])
-                df = pd.concat([df, new_patient], ignore_index=True)
-                save_data(df)
+                append_patients(new_patient)
                 st.success("Patient record saved!")
                 st.rerun()
 
 def view_patients():
     st.subheader("View Patient Records")
-    df = load_data()
     
     # Add filters
     col1, col2, col3 = st.columns(3)
     with col1:
         search_name = st.text_input("Search by Name")
+        fuzzy_search = st.checkbox("Fuzzy match")
     with col2:
         filter_source = st.selectbox("Filter by Source", ["All", "Manual Entry", "Hospital Integration", "FHIR Server"])
     with col3:
         filter_gender = st.selectbox("Filter by Gender", ["All", "Male", "Female", "Other"])
     
     # Apply filters
-    filtered_df = df.copy()
-    
-    if search_name:
-        filtered_df = filtered_df[filtered_df["Name"].str.contains(search_name, case=False, na=False)]
-    
+    filters = []
     if filter_source != "All":
-        filtered_df = filtered_df[filtered_df["Source"] == filter_source]
-    
+        filters.append(("Source", "==", filter_source))
     if filter_gender != "All":
-        filtered_df = filtered_df[filtered_df["Gender"] == filter_gender]
+        filters.append(("Gender", "==", filter_gender))
     
     # Display stats
+    aggregates = patient_aggregates()
+    source_counts = aggregates["counts"]["Source"]
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Total Patients", len(df))
+        st.metric("Total Patients", aggregates["total"])
     with col2:
-        st.metric("Manual Entry", len(df[df["Source"] == "Manual Entry"]))
+        st.metric("Manual Entry", source_counts.get("Manual Entry", 0))
     with col3:
-        st.metric("Hospital Integration", len(df[df["Source"] == "Hospital Integration"]))
+        st.metric("Hospital Integration", source_counts.get("Hospital Integration", 0))
     with col4:
-        st.metric("FHIR Server", len(df[df["Source"] == "FHIR Server"]))
+        st.metric("FHIR Server", source_counts.get("FHIR Server", 0))
+
+    with st.expander("📊 Patient Breakdown"):
+        col1, col2 = st.columns(2)
+        with col1:
+            st.write("**By Gender**")
+            st.bar_chart(pd.Series(aggregates["counts"]["Gender"], name="Patients"))
+        with col2:
+            st.write("**By Blood Type**")
+            st.bar_chart(pd.Series(aggregates["counts"]["Blood Type"], name="Patients"))
+        if aggregates["last_ingest"]:
+            st.write("**Last Ingest by Source**")
+            st.json(aggregates["last_ingest"])
+
+    # Paging and sorting: only the visible page is loaded and sent to the browser
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        sort_by = st.selectbox("Sort by", ["Row order"] + PATIENT_COLUMNS)
+    with col2:
+        descending = st.checkbox("Descending")
+    with col3:
+        page_size = st.selectbox("Rows per page", [25, 50, 100, 250], index=1)
     
-    st.dataframe(filtered_df, use_container_width=True)
+    total = count_patients(filters, search_name, fuzzy=fuzzy_search)
+    page_count = max(1, -(-total // page_size))
+    with col4:
+        page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1)
     
-    st.download_button(
-        label="Download Data as CSV",
-        data=df.to_csv(index=False).encode("utf-8"),
-        file_name="patients_data.csv",
-        mime="text/csv"
+    page_df, total = find_patients_page(
+        filters, search_name, fuzzy=fuzzy_search,
+        sort_by=None if sort_by == "Row order" else sort_by,
+        ascending=not descending,
+        offset=(page - 1) * page_size,
+        limit=page_size,
+        total=total
     )
+    st.dataframe(page_df, use_container_width=True)
+    st.caption(f"Showing {len(page_df)} of {total} matching patients")
+    
+    # Serializing the whole table is only done on request
+    if st.button("Prepare CSV Download"):
+        st.download_button(
+            label="Download Data as CSV",
+            data=load_data().to_csv(index=False).encode("utf-8"),
+            file_name="patients_data.csv",
+            mime="text/csv"
+        )
 
 def fhir_patient_search():
     st.subheader("🔍 Search FHIR Server Patients")
     
     search_term = st.text_input("Search by Name or ID")
+    max_results = st.number_input("Max results", min_value=1, max_value=1000, value=50)
     if st.button("Search FHIR Server") and search_term:
         with st.spinner("Searching FHIR server..."):
-            results = fhir_client.search_patients({'name': search_term})
+            status = st.empty()
+            patients = parse_fhir_patients(fhir_client.iter_patients(
+                {'name': search_term},
+                count=min(max_results, 100),
+                elements=PATIENT_ELEMENTS,
+                max_results=max_results
+            ))
+            found = len(patients)
             
-            if results and 'entry' in results:
-                st.success(f"Found {len(results['entry'])} patients")
-                for entry in results['entry']:
-                    patient = entry['resource']
-                    parsed_data = parse_fhir_patient_data(patient)
+            for parsed_data in _patient_records(patients):
+                with st.expander(f"Patient: {parsed_data['Name']}"):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.write(f"**Age:** {parsed_data['Age']}")
+                        st.write(f"**Gender:** {parsed_data['Gender']}")
+                        st.write(f"**Contact:** {parsed_data['Contact']}")
+                    with col2:
+                        st.write(f"**FHIR ID:** {parsed_data['FHIR_Patient_ID']}")
                     
-                    if parsed_data:
-                        with st.expander(f"Patient: {parsed_data['Name']}"):
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                st.write(f"**Age:** {parsed_data['Age']}")
-                                st.write(f"**Gender:** {parsed_data['Gender']}")
-                                st.write(f"**Contact:** {parsed_data['Contact']}")
-                            with col2:
-                                st.write(f"**FHIR ID:** {parsed_data['FHIR_Patient_ID']}")
-                            
-                            if st.button(f"Import Patient", key=f"import_{parsed_data['FHIR_Patient_ID']}"):
-                                df = load_data()
-                                new_patient = pd.DataFrame([parsed_data])
-                                df = pd.concat([df, new_patient], ignore_index=True)
-                                save_data(df)
-                                st.success("Patient imported!")
-                                st.rerun()
+                    if st.button(f"Import Patient", key=f"import_{parsed_data['FHIR_Patient_ID']}"):
+                        report = ingest_patients(pd.DataFrame([parsed_data]))
+                        st.success("Patient imported!" if report["inserted"] else "Patient already exists - record updated")
+                        st.rerun()
+            
+            if found:
+                status.success(f"Found {found} patients")
             else:
-                st.info("No patients found")
+                status.info("No patients found")
+
+def bulk_export_section():
+    with st.expander("📦 Bulk Import (FHIR $export)"):
+        st.write("Loads every patient and their observations from the server's Bulk Data export, for initial loads and nightly refreshes.")
+        checkpoint = _read_checkpoint(BULK_EXPORT_CONFIG["checkpoint_file"])
+        since = get_store().get_meta("bulk_export_since")
+        
+        if checkpoint:
+            done = sum(checkpoint["files"].values())
+            st.info(f"An interrupted import started {checkpoint['started']} ({done:,} lines loaded) will be resumed")
+            if st.button("🗑️ Discard Interrupted Import"):
+                fhir_client.cancel_export(checkpoint["status_url"])
+                os.remove(BULK_EXPORT_CONFIG["checkpoint_file"])
+                st.rerun()
+        changes_only = st.checkbox(f"Only changes since the last bulk import ({since or 'never'})", value=bool(since), disabled=not since or bool(checkpoint))
+        
+        if st.button("▶️ Resume Bulk Import" if checkpoint else "📦 Start Bulk Import", type="primary"):
+            status = st.empty()
+            def progress(stage, value):
+                if stage == "waiting":
+                    status.info(f"⏳ Server is preparing the export... {value}")
+                else:
+                    status.info(f"📥 Loaded {value:,} {stage} resources")
+            try:
+                report = bulk_import(fhir_client, BULK_EXPORT_CONFIG, since=since if changes_only else None, progress=progress)
+            except Exception as e:
+                status.empty()
+                st.error(f"Bulk import failed: {str(e)} - start it again to resume")
+            else:
+                status.success(f"✅ Imported {report['files']} files (export of {report['transaction_time'] or 'unknown time'})")
+                col1, col2, col3, col4 = st.columns(4)
+                col1.metric("Patients", f"{report['Patient']:,}")
+                col2.metric("New", f"{report['inserted']:,}")
+                col3.metric("Updated", f"{report['updated']:,}")
+                col4.metric("Observations Added", f"{report['observations_added']:,}")
 
 def sync_with_fhir():
     st.subheader("🔄 Sync with FHIR Server")
+    bulk_export_section()
     
-    df = load_data()
-    fhir_patients = df[df['FHIR_Patient_ID'].notna() & (df['FHIR_Patient_ID'] != '')]
+    linked_rows = get_store().fhir_linked_rows()
+    fhir_patients = load_rows(linked_rows.values(), columns=["Name", "FHIR_Patient_ID", "Last_Sync"])
     
     if fhir_patients.empty:
         st.info("No patients with FHIR IDs found")
     else:
         st.write(f"Found {len(fhir_patients)} patients with FHIR IDs")
         
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            workers = st.number_input("Concurrent requests", min_value=1, max_value=64, value=FHIR_CONFIG["sync_workers"])
+        with col2:
+            rate_limit = st.number_input("Max requests/sec", min_value=1, max_value=500, value=FHIR_CONFIG["sync_rate_limit"])
+        with col3:
+            sync_all = st.button("🔄 Sync All", type="primary")
+            sync_changes = st.button("⚡ Sync Changes Only")
+        
+        st.caption(f"Last incremental sync: {get_store().get_meta('sync_watermark') or 'never'}")
+        
+        if sync_changes:
+            with st.spinner("Fetching patients changed since the last sync..."):
+                try:
+                    report = sync_changed_patients(
+                        fhir_client,
+                        chunk_size=FHIR_CONFIG["batch_size"],
+                        clock_skew=FHIR_CONFIG["sync_clock_skew"]
+                    )
+                    st.success(f"Checked {report['checked']} patients, {report['changed']} changed since {report['since'] or 'the beginning'}")
+                except Exception as e:
+                    st.error(f"Incremental sync failed: {str(e)}")
+        
+        if sync_all:
+            with st.spinner(f"Syncing {len(fhir_patients)} patients..."):
+                report = sync_all_patients(fhir_client, max_workers=workers, rate_limit=rate_limit,
+                                           batch_size=FHIR_CONFIG["batch_size"])
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Synced", report["synced"])
+            col2.metric("Failed", len(report["failed"]))
+            col3.metric("Patients/sec", f"{report['per_second']:.1f}")
+            if report["failed"]:
+                st.dataframe(pd.DataFrame(list(report["failed"].items()), columns=["FHIR_Patient_ID", "Error"]))
+        
         for idx, patient in fhir_patients.iterrows():
             with st.expander(f"Sync: {patient['Name']}"):
                 col1, col2 = st.columns(2)
@@ -304,18 +2999,85 @@ def sync_with_fhir():
                 with col2:
                     if st.button(f"Sync Now", key=f"sync_{idx}"):
                         with st.spinner("Syncing..."):
-                            fhir_data = fhir_client.get_patient_details(patient['FHIR_Patient_ID'])
+                            fhir_data = fhir_client.get_patient_details(patient['FHIR_Patient_ID'], revalidate=True)
                             if fhir_data:
                                 updated_data = parse_fhir_patient_data(fhir_data)
                                 if updated_data:
-                                    for key, value in updated_data.items():
-                                        if key != 'FHIR_Patient_ID':
-                                            df.at[idx, key] = value
-                                    save_data(df)
+                                    synced = merge_synced_patient(load_rows([idx]).loc[idx].to_dict(), updated_data)
+                                    update_patients([idx], pd.DataFrame([synced]))
                                     st.success("Synced!")
                                     st.rerun()
 
 # Hospital Integration Demo Functions
+def observations_page():
+    st.subheader("🩺 Observations & Vitals")
+    
+    linked_rows = get_store().fhir_linked_rows()
+    if not linked_rows:
+        st.info("No patients with FHIR IDs found - import patients from the FHIR server first")
+        return
+    
+    vitals = st.multiselect("Vital signs", list(VITAL_CODES), default=list(VITAL_CODES), format_func=VITAL_CODES.get)
+    
+    if st.button("📥 Fetch Observations", type="primary"):
+        with st.spinner(f"Fetching observations for {len(linked_rows)} patients..."):
+            try:
+                report = sync_observations(fhir_client, list(linked_rows), codes=vitals)
+                st.success(f"✅ Fetched {report['fetched']} values, {report['added']} new")
+            except Exception as e:
+                st.error(f"Error fetching observations: {str(e)}")
+    
+    observations = get_observation_store().load()
+    if observations.empty:
+        st.info("No observations stored yet")
+        return
+    
+    summary = vitals_summary(observations, codes=vitals)
+    names = load_rows(linked_rows.values(), columns=["Name", "FHIR_Patient_ID"])
+    names = dict(zip(names["FHIR_Patient_ID"].map(normalize_fhir_id), names["Name"]))
+    summary.insert(1, "Name", summary["patient_id"].astype(str).map(names))
+    
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Stored Values", len(observations))
+    col2.metric("Patients with Vitals", summary["patient_id"].nunique())
+    col3.metric("Latest Observation", str(observations["effective"].max())[:16])
+    
+    st.write("**Latest Vitals**")
+    latest = summary.pivot_table(index=["patient_id", "Name"], columns="vital", values="latest", aggfunc="last", observed=True)
+    st.dataframe(latest, use_container_width=True)
+    
+    with st.expander("📈 Ranges and Trends"):
+        st.dataframe(summary, use_container_width=True)
+
+HOSPITAL_COLUMN_MAP = {"BloodType": "Blood Type", "MedicalHistory": "Medical History"}
+IMPORT_CHUNK_ROWS = 50000
+PREVIEW_ROWS = 100
+
+def normalize_hospital_chunk(chunk, sync_time):
+    patients = chunk.rename(columns=HOSPITAL_COLUMN_MAP).reindex(columns=PATIENT_COLUMNS, fill_value="")
+    if "Age" not in chunk.columns:
+        patients["Age"] = 0
+    patients["FHIR_Patient_ID"] = ""
+    patients["Last_Sync"] = sync_time
+    patients["Source"] = "Hospital Integration"
+    return patients
+
+def import_hospital_file(source, chunksize=IMPORT_CHUNK_ROWS, progress=None):
+    # Stream the upload through the store one chunk at a time so memory stays
+    # bounded by the chunk size however large the hospital export is.
+    total_bytes = getattr(source, "size", None)
+    sync_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    totals = defaultdict(int)
+
+    for chunk in pd.read_csv(source, chunksize=chunksize):
+        for key, value in ingest_patients(normalize_hospital_chunk(chunk, sync_time)).items():
+            totals[key] += value
+        if progress:
+            fraction = min(source.tell() / total_bytes, 1.0) if total_bytes else None
+            progress(totals["incoming"], fraction)
+
+    return dict(totals)
+
 def hospital_file_integration():
     st.subheader("📄 Hospital File Integration Demo")
     
@@ -350,40 +3112,31 @@ def hospital_file_integration():
     
     if uploaded_file:
         try:
-            hospital_data = pd.read_csv(uploaded_file)
-            st.success(f"✅ File loaded successfully! Found {len(hospital_data)} patients")
+            preview = pd.read_csv(uploaded_file, nrows=PREVIEW_ROWS)
+            uploaded_file.seek(0)
+            st.success(f"✅ File loaded successfully! ({uploaded_file.size / 1024:,.0f} KB)")
             
-            st.write("**Preview of Hospital Data:**")
-            st.dataframe(hospital_data)
+            st.write(f"**Preview of Hospital Data (first {len(preview)} rows):**")
+            st.dataframe(preview)
             
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("🚀 Import All Patients", type="primary"):
-                    with st.spinner("Importing patients..."):
-                        df = load_data()
-                        imported_count = 0
-                        
-                        for _, row in hospital_data.iterrows():
-                            new_patient = pd.DataFrame([{
-                                "Name": row.get('Name', ''),
-                                "Age": row.get('Age', 0),
-                                "Gender": row.get('Gender', ''),
-                                "Contact": row.get('Contact', ''),
-                                "Blood Type": row.get('BloodType', ''),
-                                "Allergies": row.get('Allergies', ''),
-                                "Medical History": row.get('MedicalHistory', ''),
-                                "FHIR_Patient_ID": "",
-                                "Last_Sync": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                "Source": "Hospital Integration"
-                            }])
-                            df = pd.concat([df, new_patient], ignore_index=True)
-                            imported_count += 1
-                        
-                        save_data(df)
-                        st.success(f"🎉 Successfully imported {imported_count} patients from hospital!")
-                        st.balloons()
-                        time.sleep(2)
-                        st.rerun()
+                    progress_bar = st.progress(0.0, text="Importing patients...")
+                    
+                    def show_progress(rows, fraction):
+                        progress_bar.progress(fraction or 0.0, text=f"Imported {rows:,} patients...")
+                    
+                    report = import_hospital_file(uploaded_file, progress=show_progress)
+                    progress_bar.progress(1.0, text=f"Imported {report.get('incoming', 0):,} patients")
+                    st.success(
+                        f"🎉 Successfully imported {report.get('incoming', 0)} patients from hospital! "
+                        f"{report.get('inserted', 0)} new, {report.get('updated', 0)} updated, "
+                        f"{report.get('merged', 0)} duplicates merged"
+                    )
+                    st.balloons()
+                    time.sleep(2)
+                    st.rerun()
             
             with col2:
                 if st.button("❌ Cancel Import"):
@@ -426,46 +3179,51 @@ Content-Type: application/json
 {json.dumps(api_demo_data, indent=2)}
     """, language="json")
     
+    ingest_server = get_ingest_server()
+    if ingest_server.error:
+        st.error(ingest_server.error)
+    else:
+        st.caption(f"Ingestion endpoint: POST {ingest_server.url}/api/patients (single patient, list, or {{\"patients\": [...]}})")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Queued", ingest_server.queue_depth())
+        with col2:
+            st.metric("Batches Written", ingest_server.stats["batches"])
+        with col3:
+            st.metric("Patients Ingested", ingest_server.stats["written"])
+        st.caption(
+            f"{ingest_server.stats['inserted']} new, {ingest_server.stats['updated']} updated, "
+            f"{ingest_server.stats['merged']} duplicates merged"
+        )
+    
     col1, col2 = st.columns(2)
     
     with col1:
-        if st.button("🎯 Simulate API Call", type="primary"):
+        if st.button("🎯 Simulate API Call", type="primary", disabled=bool(ingest_server.error)):
             with st.spinner("Processing API request..."):
-                time.sleep(2)  # Simulate processing
-                
-                # Add to database
-                df = load_data()
-                new_patient = pd.DataFrame([{
-                    "Name": api_demo_data['name'],
-                    "Age": api_demo_data['age'],
-                    "Gender": api_demo_data['gender'],
-                    "Contact": api_demo_data['contact'],
-                    "Blood Type": api_demo_data['blood_type'],
-                    "Allergies": api_demo_data['allergies'],
-                    "Medical History": api_demo_data['medical_history'],
-                    "FHIR_Patient_ID": api_demo_data['patient_id'],
-                    "Last_Sync": api_demo_data['timestamp'],
-                    "Source": "Hospital Integration"
-                }])
-                
-                df = pd.concat([df, new_patient], ignore_index=True)
-                save_data(df)
-                
-                st.success("✅ API request processed successfully!")
-                st.json({"status": "success", "message": "Patient created", "patient_id": api_demo_data['patient_id']})
-                st.balloons()
+                try:
+                    response = requests.post(f"{ingest_server.url}/api/patients", json=api_demo_data, timeout=10)
+                    if response.status_code == 202:
+                        st.success("✅ API request accepted - the patient is written with the next batch")
+                        st.balloons()
+                    else:
+                        st.error(f"API request rejected: {response.status_code}")
+                    st.json(response.json())
+                except requests.exceptions.RequestException as e:
+                    st.error(f"Error calling ingestion endpoint: {str(e)}")
     
     with col2:
         if st.button("📊 View Integration Stats"):
-            df = load_data()
-            hospital_patients = df[df["Source"] == "Hospital Integration"]
+            aggregates = patient_aggregates()
+            hospital_count = aggregates["counts"]["Source"].get("Hospital Integration", 0)
             
-            st.metric("Hospital Integrated Patients", len(hospital_patients))
-            st.metric("Total API Calls", len(hospital_patients))
+            st.metric("Hospital Integrated Patients", hospital_count)
+            st.metric("Total API Calls", hospital_count)
             
-            if len(hospital_patients) > 0:
+            recent = [entry for entry in aggregates["recent"] if entry["source"] == "Hospital Integration"]
+            if recent:
                 st.write("**Recent Hospital Integrations:**")
-                st.dataframe(hospital_patients.tail(5)[["Name", "Last_Sync", "Source"]])
+                st.dataframe(pd.DataFrame(recent[-5:]))
 
 def webhook_demo():
     st.subheader("📡 Webhook Integration Demo")
@@ -478,6 +3236,20 @@ def webhook_demo():
     4. Patient record automatically updated!
     """)
     
+    webhook_queue = get_webhook_queue()
+    
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Queue Depth", webhook_queue.depth())
+    with col2:
+        st.metric("Lag", f"{webhook_queue.lag():.1f}s")
+    with col3:
+        st.metric("Events Received", webhook_queue.stats["received"])
+    with col4:
+        st.metric("Coalesced", webhook_queue.stats["coalesced"])
+    if webhook_queue.stats["last_error"]:
+        st.error(f"Last batch failed: {webhook_queue.stats['last_error']}")
+    
     # Webhook simulation
     webhook_data = {
         "event": "patient_updated",
@@ -485,7 +3257,18 @@ def webhook_demo():
         "hospital": "Demo Medical Center",
         "event_type": "update",
         "timestamp": datetime.now().isoformat(),
-        "changes": ["contact", "medical_history"]
+        "changes": ["contact", "medical_history"],
+        "patient": {
+            "patient_id": "HOSP-WEBHOOK-001",
+            "name": "Webhook Demo Patient",
+            "age": 42,
+            "gender": "Male",
+            "contact": "555-WEBHOOK-NEW",
+            "blood_type": "O-",
+            "allergies": "None",
+            "medical_history": "Updated: Recent surgery completed successfully",
+            "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
     }
     
     st.write("**Webhook Notification Received:**")
@@ -495,59 +3278,36 @@ def webhook_demo():
     
     with col1:
         if st.button("🔄 Process Webhook", type="primary"):
-            with st.spinner("Processing webhook notification..."):
-                time.sleep(1)
-                st.info("🔍 Fetching updated patient data from hospital...")
-                time.sleep(2)
-                
-                # Simulate updated patient data
-                updated_patient = {
-                    "Name": "Webhook Demo Patient",
-                    "Age": 42,
-                    "Gender": "Male",
-                    "Contact": "555-WEBHOOK-NEW",  # Updated
-                    "Blood Type": "O-",
-                    "Allergies": "None",
-                    "Medical History": "Updated: Recent surgery completed successfully",  # Updated
-                    "FHIR_Patient_ID": webhook_data['patient_id'],
-                    "Last_Sync": webhook_data['timestamp'],
-                    "Source": "Hospital Integration"
-                }
-                
-                # Check if patient exists, update or create
-                df = load_data()
-                existing_patient = df[df['FHIR_Patient_ID'] == webhook_data['patient_id']]
-                
-                if len(existing_patient) > 0:
-                    # Update existing
-                    idx = existing_patient.index[0]
-                    for key, value in updated_patient.items():
-                        df.at[idx, key] = value
-                    action = "updated"
-                else:
-                    # Create new
-                    new_patient = pd.DataFrame([updated_patient])
-                    df = pd.concat([df, new_patient], ignore_index=True)
-                    action = "created"
-                
-                save_data(df)
-                
-                st.success(f"✅ Patient record {action} via webhook!")
-                st.write("**Updated Patient Data:**")
-                st.json(updated_patient)
+            seq = webhook_queue.submit(webhook_data)
+            st.success(f"✅ Event #{seq} logged - applied once the patient has been quiet for {WEBHOOK_CONFIG['debounce']:.0f}s")
+        
+        if st.button("🌊 Simulate Burst (100 events, 5 patients)"):
+            for i in range(100):
+                event = json.loads(json.dumps(webhook_data))
+                event["patient_id"] = event["patient"]["patient_id"] = f"HOSP-WEBHOOK-{i % 5 + 1:03d}"
+                event["patient"]["contact"] = f"555-{i:04d}"
+                webhook_queue.submit(event)
+            st.success(f"✅ 100 events logged for 5 patients ({webhook_queue.depth()} patients queued)")
+        
+        if st.button("⚡ Apply Queue Now"):
+            result = webhook_queue.process(force=True)
+            if result:
+                st.success(f"✅ {result['events']} patients applied in one write: {result['created']} created, {result['updated']} updated")
+            else:
+                st.info("Nothing to apply")
     
     with col2:
         if st.button("📈 Webhook Logs"):
             st.write("**Recent Webhook Events:**")
-            webhook_logs = [
-                {"timestamp": "2024-01-15 10:30:00", "event": "patient_created", "status": "success"},
-                {"timestamp": "2024-01-15 11:45:00", "event": "patient_updated", "status": "success"},
-                {"timestamp": "2024-01-15 14:20:00", "event": "patient_deleted", "status": "success"},
-                {"timestamp": "2024-01-15 16:10:00", "event": "patient_updated", "status": "pending"}
-            ]
-            
-            log_df = pd.DataFrame(webhook_logs)
+            log_df = pd.DataFrame(webhook_queue.recent_events())
             st.dataframe(log_df)
+            if webhook_queue.stats["last_batch"]:
+                st.write("**Last Applied Batch:**")
+                st.json(webhook_queue.stats["last_batch"])
+        
+        if st.button("🔁 Replay Event Log"):
+            count = webhook_queue.replay(from_checkpoint=False)
+            st.success(f"✅ {count} logged events re-queued ({webhook_queue.depth()} patients)")
 
 def hospital_integration_demo():
     st.subheader("🏥 Hospital Integration Demo Center")
@@ -563,8 +3323,7 @@ def hospital_integration_demo():
             st.write("• Webhook Notifications")
         
         with col2:
-            df = load_data()
-            hospital_count = len(df[df["Source"] == "Hospital Integration"])
+            hospital_count = patient_aggregates()["counts"]["Source"].get("Hospital Integration", 0)
             st.metric("Integrated Patients", hospital_count)
         
         with col3:
@@ -586,56 +3345,128 @@ def hospital_integration_demo():
     elif integration_type == "📡 Webhook Integration":
         webhook_demo()
 
-# Sidebar menu
-menu = st.sidebar.selectbox("Menu", [
-    "Add Patient", 
-    "View Patients", 
-    "FHIR Patient Search",
-    "Sync with FHIR",
-    "🔗 Hospital Integration Demo"
-])
-
-# Main app logic
-show_configuration()
-
-if menu == "Add Patient":
-    add_patient()
-elif menu == "View Patients":
-    view_patients()
-elif menu == "FHIR Patient Search":
-    fhir_patient_search()
-elif menu == "Sync with FHIR":
-    sync_with_fhir()
-elif menu == "🔗 Hospital Integration Demo":
-    hospital_integration_demo()
-
-# Status indicator
-st.sidebar.markdown("---")
-st.sidebar.success("✅ Connected to public FHIR server")
-st.sidebar.info("🔗 Integration demos active")
-
-# Demo instructions
-with st.sidebar.expander("📖 Demo Instructions"):
-    st.markdown("""
-    **Hospital Integration Demo:**
-    1. Go to Integration Demo section
-    2. Try different integration types
-    3. Upload sample files or simulate API calls
-    4. View integrated patients in "View Patients"
-    
-    **For Presentations:**
-    - Show current patients first
-    - Demonstrate integration process
-    - Show new patients after integration
-    """)
+def render_page(menu):
+    if menu == "Add Patient":
+        add_patient()
+    elif menu == "View Patients":
+        view_patients()
+    elif menu == "FHIR Patient Search":
+        fhir_patient_search()
+    elif menu == "Sync with FHIR":
+        sync_with_fhir()
+    elif menu == "🩺 Observations":
+        observations_page()
+    elif menu == "🔗 Hospital Integration Demo":
+        hospital_integration_demo()
+    elif menu == "📈 Diagnostics":
+        diagnostics_page()
 
-# ROI Calculator
-with st.sidebar.expander("💰 ROI Calculator"):
-    st.write("**Integration Benefits:**")
-    patients = st.number_input("Hospital patients", 100, 10000, 1000)
-    time_per_patient = st.slider("Minutes saved per patient", 1, 10, 5)
-    hourly_rate = st.number_input("Staff hourly rate ($)", 20, 100, 30)
+def show_profile(profiler):
+    stats = pstats.Stats(profiler)
+    rows = [
+        {"Function": f"{function} ({os.path.basename(filename)}:{line})", "Calls": calls,
+         "Own ms": own * 1000, "Cumulative ms": cumulative * 1000}
+        for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items()
+    ]
+    top = pd.DataFrame(rows).sort_values("Cumulative ms", ascending=False).head(METRICS_CONFIG["profile_rows"])
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats()
+    
+    with st.expander("🔬 Profile of this rerun", expanded=True):
+        st.caption(f"{stats.total_calls:,} calls in {stats.total_tt * 1000:,.0f} ms")
+        st.dataframe(top, use_container_width=True, hide_index=True)
+        st.download_button("Download Full Profile", report.getvalue(), "profile.txt", "text/plain")
+
+def diagnostics_page():
+    st.subheader("📈 Diagnostics")
+    snapshot = metrics.snapshot()
+    
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Operations Recorded", f"{snapshot['Calls'].sum():,}")
+    col2.metric("Errors", f"{snapshot['Errors'].sum():,}")
+    col3.metric("Time Measured", f"{snapshot['Total s'].sum():,.1f}s")
+    col4.metric("Since", datetime.fromtimestamp(metrics.started).strftime('%Y-%m-%d %H:%M'))
+    
+    if snapshot.empty:
+        st.info("Nothing recorded yet - use the other pages and come back")
+        return
+    
+    kind = st.radio("Show", ["All", "page", "store", "fhir"], horizontal=True)
+    if kind != "All":
+        snapshot = snapshot[snapshot["Kind"] == kind]
+    st.dataframe(snapshot.round(2), use_container_width=True, hide_index=True)
+    st.bar_chart(snapshot.set_index("Operation")["p95 ms"].head(20))
     
-    monthly_savings = (patients * time_per_patient * hourly_rate) / 60
-    st.metric("Monthly Savings", f"${monthly_savings:,.0f}")
-    st.metric("Annual Savings", f"${monthly_savings * 12:,.0f}")
\ No newline at end of file
+    with st.expander("📤 Prometheus Export"):
+        text = metrics.prometheus()
+        st.caption(f"Also served at {INGEST_CONFIG['host']}:{INGEST_CONFIG['port']}/metrics while the ingestion endpoint is running")
+        st.download_button("Download metrics.prom", text, "metrics.prom", "text/plain")
+        st.code(text, language="text")
+    
+    if st.button("🗑️ Reset Metrics"):
+        metrics.reset()
+        st.rerun()
+
+def main():
+    # Streamlit App
+    st.set_page_config(page_title="Patient Health Records", layout="wide")
+    st.title("🏥 Patient Health Records - FHIR Integration with Demo")
+    
+    # Sidebar menu
+    menu = st.sidebar.selectbox("Menu", [
+        "Add Patient", 
+        "View Patients", 
+        "FHIR Patient Search",
+        "Sync with FHIR",
+        "🩺 Observations",
+        "🔗 Hospital Integration Demo",
+        "📈 Diagnostics"
+    ])
+    profile = st.sidebar.checkbox("🔬 Profile page renders")
+
+    # Main app logic
+    show_configuration()
+
+    profiler = cProfile.Profile() if profile else None
+    with metrics.span("page", menu):
+        if profiler is None:
+            render_page(menu)
+        else:
+            profiler.runcall(render_page, menu)
+    if profiler is not None:
+        show_profile(profiler)
+
+    # Status indicator
+    st.sidebar.markdown("---")
+    st.sidebar.success("✅ Connected to public FHIR server")
+    st.sidebar.info("🔗 Integration demos active")
+
+    # Demo instructions
+    with st.sidebar.expander("📖 Demo Instructions"):
+        st.markdown("""
+        **Hospital Integration Demo:**
+        1. Go to Integration Demo section
+        2. Try different integration types
+        3. Upload sample files or simulate API calls
+        4. View integrated patients in "View Patients"
+
+        **For Presentations:**
+        - Show current patients first
+        - Demonstrate integration process
+        - Show new patients after integration
+        """)
+
+    # ROI Calculator
+    with st.sidebar.expander("💰 ROI Calculator"):
+        st.write("**Integration Benefits:**")
+        patients = st.number_input("Hospital patients", 100, 10000, 1000)
+        time_per_patient = st.slider("Minutes saved per patient", 1, 10, 5)
+        hourly_rate = st.number_input("Staff hourly rate ($)", 20, 100, 30)
+
+        monthly_savings = (patients * time_per_patient * hourly_rate) / 60
+        st.metric("Monthly Savings", f"${monthly_savings:,.0f}")
+        st.metric("Annual Savings", f"${monthly_savings * 12:,.0f}")
+
+# Streamlit runs this file as __main__; importing it (e.g. from benchmarks/) only defines things
+if __name__ == "__main__":
+    main()